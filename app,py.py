@@ -1,10 +1,33 @@
 import streamlit as st
-import random
+import os
 import time
+import hashlib
+import io
+import logging
 import json # For parsing API response
-# No direct image generation or complex TTS libraries are imported here,
+import re
+import sqlite3
+import threading
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests # For the engine service client
+from requests.adapters import HTTPAdapter
+import numpy as np # Embedding matrix for long-term memory retrieval
+# Conversation logic (preferences, memory, prompts, response cache, model backend) lives in jake_engine.py,
+# so it can also run as a separate service (jake_engine_service.py)
+from jake_engine import (
+    DEFAULT_PERSONALITY, FALLBACK_REPLY, ChatHistory, MemoryStore, PromptBuilder, ResponseCache,
+    RESPONSE_CACHE_SESSION_ENTRIES, RESPONSE_CACHE_TTL,
+    backfill_preferences, generate_reply, get_metrics, get_model_scheduler, learn_preference, metrics_span,
+    parse_transcript, record_turn_metrics, stream_reply,
+)
+from PIL import Image, ImageDraw # Local avatar rendering (Pillow ships with Streamlit)
+# No image generation models or complex TTS libraries are imported here,
 # as they would require separate models/APIs beyond basic LLM.
 
+logger = logging.getLogger("jake_app") # Streamlit runs this script as __main__
+
 # --- Configuration & Setup ---
 ST_CONFIG = {
     "page_title": "Jake: Your Personalized AI Companion",
@@ -12,18 +35,356 @@ ST_CONFIG = {
     "layout": "wide",
 }
 
-# --- Google Gemini API Configuration (Free Tier: gemini-2.0-flash) ---
-# IMPORTANT: In a deployed app, you'd securely load this from .streamlit/secrets.toml
-# For local testing, you might temporarily set it as an environment variable or hardcode (NOT RECOMMENDED for production)
-# Example of how it *would* be loaded securely in a Streamlit Cloud deployment:
-# GEMINI_API_KEY = st.secrets.get("GEMINI_API_KEY", "")
-# For this Canvas environment, leaving it as an empty string should allow the runtime to inject it.
-GEMINI_API_KEY = "" # Leave as empty string for Canvas runtime to provide it.
+# --- Engine Configuration ---
+# The model backend, mock latency, context window and response cache are configured in jake_engine.py.
+# With JAKE_ENGINE_URL set (e.g. http://127.0.0.1:8700), replies come from jake_engine_service.py;
+# otherwise the engine runs in-process, in the Streamlit script thread (handy for development).
+ENGINE_SERVICE_URL = os.environ.get("JAKE_ENGINE_URL", "").rstrip("/")
+ENGINE_SERVICE_TIMEOUT = (5.0, 120.0) # (connect, read) seconds
+
+# --- Streaming Configuration ---
+# When enabled, Jake's reply is rendered chunk by chunk (st.write_stream) instead of appearing all at once after a spinner.
+STREAM_RESPONSES = True
+
+# --- Persistent Storage Configuration ---
+# Chat history, preferences, memories and Jake's settings are stored per user in an embedded SQLite database.
+JAKE_DB_PATH = os.environ.get("JAKE_DB_PATH", "jake_data.sqlite3")
+HISTORY_PAGE_SIZE = 50 # Messages loaded at login; earlier ones are loaded page by page on demand
+
+# --- Chat Rendering Configuration ---
+CHAT_RENDER_WINDOW = 30 # Messages rendered in the chat pane; "Load earlier messages" shows this many more each time
+
+# --- Instrumentation Configuration ---
+# Per-stage timings and counters are aggregated per process and exported in OpenMetrics text format:
+# to a file (JAKE_METRICS_FILE, rewritten at most every METRICS_FILE_INTERVAL seconds) and/or over HTTP at
+# http://JAKE_METRICS_HOST:JAKE_METRICS_PORT/metrics. The endpoint only listens on localhost unless JAKE_METRICS_HOST
+# says otherwise (e.g. 0.0.0.0 for a scraper on another host): metrics reveal usage patterns. The sidebar diagnostics expander can be hidden with JAKE_DIAGNOSTICS=0.
+METRICS_FILE_PATH = os.environ.get("JAKE_METRICS_FILE", "")
+METRICS_FILE_INTERVAL = 5.0
+METRICS_PORT = int(os.environ.get("JAKE_METRICS_PORT", "0")) # 0 disables the HTTP endpoint
+METRICS_HOST = os.environ.get("JAKE_METRICS_HOST", "127.0.0.1")
+SHOW_DIAGNOSTICS = os.environ.get("JAKE_DIAGNOSTICS", "1") != "0"
+TURN_METRICS_KEPT = 50 # Per-session latency records kept for the diagnostics panel
+
+# --- Avatar Configuration ---
+# Avatars are drawn locally and cached as PNG files named by a hash of the look, so reruns and
+# history replay never fetch images from a third party. JAKE_PREWARM_AVATARS=1 renders every combination at startup.
+AVATAR_CACHE_DIR = os.environ.get("JAKE_AVATAR_CACHE_DIR", ".jake_avatars")
+AVATAR_PREWARM = os.environ.get("JAKE_PREWARM_AVATARS", "0") == "1"
+AVATAR_SIZE = 128 # Pixels; square
+AVATAR_RENDER_VERSION = 1 # Bump when the drawing code changes, so cached files from the old renderer are not reused
+AVATAR_OPTIONS = {
+    "hair_style": ["Short", "Medium", "Long", "Curly", "Spiky", "Wavy"],
+    "eye_color": ["Blue", "Brown", "Green", "Hazel", "Gray"],
+    "body_type": ["Athletic", "Lean", "Muscular", "Average", "Broad"],
+    "clothing_style": ["Casual", "Formal", "Sporty", "Edgy", "Classic"],
+}
+VOICE_TONES = ["Warm", "Deep", "Energetic", "Calm", "Playful"] # Not part of the image
+
+# --- Persistent Storage ---
+class ChatStore:
+    """
+    Per-user storage in SQLite (WAL mode), shared by all sessions of the process (see get_chat_store).
+    Each turn's changes are written in a single transaction, and chat history is read in pages
+    so a session only holds the messages it actually shows.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            message TEXT NOT NULL,
+            avatar_id TEXT, -- See avatar_key
+            created_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_messages_user_id ON messages (user_id, id);
+        CREATE TABLE IF NOT EXISTS preferences (
+            user_id TEXT NOT NULL,
+            topic TEXT NOT NULL,
+            value TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (user_id, topic, value)
+        );
+        CREATE TABLE IF NOT EXISTS memories (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            snippet TEXT NOT NULL,
+            embedding BLOB NOT NULL,
+            UNIQUE (user_id, snippet)
+        );
+        CREATE TABLE IF NOT EXISTS user_settings (
+            user_id TEXT PRIMARY KEY,
+            jake_personality TEXT NOT NULL,
+            jake_avatar_config TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path=JAKE_DB_PATH):
+        self.path = path
+        # One connection shared across Streamlit's script threads; the lock serializes access to it
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL") # Safe with WAL; only the last commits can be lost on power failure
+            self.conn.executescript(self.SCHEMA)
+
+    def load_history_page(self, user_id, before_id=None, limit=HISTORY_PAGE_SIZE):
+        """Up to `limit` messages older than `before_id` (or the newest ones), as (id, role, message, avatar_id), oldest first."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, role, message, avatar_id FROM messages WHERE user_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                (user_id, before_id if before_id is not None else 2 ** 63 - 1, limit),
+            ).fetchall()
+        return rows[::-1]
+
+    def load_user(self, user_id, history_limit=HISTORY_PAGE_SIZE):
+        """Everything needed to restore a session: latest history page, preferences, memories and settings."""
+        history = self.load_history_page(user_id, limit=history_limit)
+        with self.lock:
+            preference_rows = self.conn.execute(
+                "SELECT topic, value FROM preferences WHERE user_id = ? ORDER BY created_at, rowid", (user_id,)
+            ).fetchall()
+            memory_rows = self.conn.execute(
+                "SELECT snippet, embedding FROM memories WHERE user_id = ? ORDER BY id", (user_id,)
+            ).fetchall()
+            settings_row = self.conn.execute(
+                "SELECT jake_personality, jake_avatar_config FROM user_settings WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        preferences = {}
+        for topic, value in preference_rows:
+            preferences.setdefault(topic, []).append(value)
+        return {
+            "history": history,
+            "preferences": preferences,
+            "memory_snippets": [snippet for snippet, _ in memory_rows],
+            "memory_embeddings": [np.frombuffer(embedding, dtype=np.float32) for _, embedding in memory_rows],
+            "jake_personality": json.loads(settings_row[0]) if settings_row else None,
+            "jake_avatar_config": json.loads(settings_row[1]) if settings_row else None,
+        }
+
+    def save_turn(self, user_id, messages, preferences, memories, personality, avatar_config):
+        """
+        Writes one turn's changes in a single transaction.
+        `messages` are (role, message, avatar_id) tuples to append, `preferences` (topic, value) pairs and
+        `memories` (snippet, embedding) pairs to insert if new. Returns the id of the last inserted message.
+        """
+        now = time.time()
+        with self.lock, self.conn: # The connection context manager commits (or rolls back) the transaction
+            last_id = None
+            for role, message, avatar_id in messages:
+                last_id = self.conn.execute(
+                    "INSERT INTO messages (user_id, role, message, avatar_id, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (user_id, role, message, avatar_id, now),
+                ).lastrowid
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO preferences (user_id, topic, value, created_at) VALUES (?, ?, ?, ?)",
+                [(user_id, topic, value, now) for topic, value in preferences],
+            )
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO memories (user_id, snippet, embedding) VALUES (?, ?, ?)",
+                [(user_id, snippet, np.asarray(embedding, dtype=np.float32).tobytes()) for snippet, embedding in memories],
+            )
+            self.conn.execute(
+                "INSERT INTO user_settings (user_id, jake_personality, jake_avatar_config, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET jake_personality = excluded.jake_personality, "
+                "jake_avatar_config = excluded.jake_avatar_config, updated_at = excluded.updated_at",
+                (user_id, json.dumps(personality), json.dumps(avatar_config), now),
+            )
+        return last_id
+
+@st.cache_resource
+def get_chat_store():
+    """One database connection per process, shared by all sessions."""
+    return ChatStore(JAKE_DB_PATH)
+
+# --- Metrics Export ---
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Serves GET /metrics for Prometheus-compatible scrapers."""
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = get_metrics().render_openmetrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/openmetrics-text; version=1.0.0; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Scrapes would flood the Streamlit log
+
+@st.cache_resource
+def start_metrics_endpoint():
+    """Starts the /metrics endpoint once per process, if JAKE_METRICS_PORT is set."""
+    if not METRICS_PORT:
+        return None
+    try:
+        server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), MetricsRequestHandler)
+    except OSError as e:
+        logger.warning("Metrics endpoint disabled: couldn't bind %s:%s: %s", METRICS_HOST, METRICS_PORT, e)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="jake-metrics", daemon=True).start()
+    return server
+
+# --- Avatar Rendering ---
+AVATAR_ID_PATTERN = re.compile(r"^jake-[0-9a-f]{16}$")
+AVATAR_BACKGROUND = (173, 216, 230)
+AVATAR_SKIN = (241, 194, 155)
+AVATAR_HAIR = (74, 48, 28)
+AVATAR_EYE_COLORS = {"Blue": (52, 110, 196), "Brown": (110, 68, 36), "Green": (58, 148, 78), "Hazel": (150, 118, 58), "Gray": (128, 138, 150)}
+AVATAR_SHOULDER_WIDTHS = {"Lean": 0.46, "Average": 0.56, "Athletic": 0.62, "Muscular": 0.72, "Broad": 0.8} # Fractions of the image width
+AVATAR_CLOTHING_COLORS = {"Casual": (70, 130, 180), "Formal": (38, 40, 58), "Sporty": (214, 62, 62), "Edgy": (34, 34, 34), "Classic": (139, 94, 52)}
+
+def avatar_key(avatar_config):
+    """Content address of an avatar: a hash of every field that affects the drawing, plus the renderer version."""
+    look = {field: avatar_config.get(field, options[0]) for field, options in AVATAR_OPTIONS.items()}
+    look["render_version"] = AVATAR_RENDER_VERSION
+    digest = hashlib.blake2b(json.dumps(look, sort_keys=True).encode("utf-8"), digest_size=8).hexdigest()
+    return f"jake-{digest}"
+
+def render_avatar_png(avatar_config, size=AVATAR_SIZE):
+    """Draws Jake's head-and-shoulders portrait for an avatar config and returns it as PNG bytes."""
+    hair = avatar_config.get("hair_style", "Short")
+    clothing = avatar_config.get("clothing_style", "Casual")
+    u = size / 100 # Coordinates below are on a 100x100 grid
+    image = Image.new("RGB", (size, size), AVATAR_BACKGROUND)
+    draw = ImageDraw.Draw(image)
+
+    # Long hair falls behind the head and shoulders, so it is drawn first
+    if hair == "Long":
+        draw.rounded_rectangle((29 * u, 18 * u, 71 * u, 78 * u), radius=14 * u, fill=AVATAR_HAIR)
+
+    # Shoulders and clothing
+    half_width = 50 * AVATAR_SHOULDER_WIDTHS.get(avatar_config.get("body_type"), 0.62)
+    clothing_color = AVATAR_CLOTHING_COLORS.get(clothing, AVATAR_CLOTHING_COLORS["Casual"])
+    draw.rounded_rectangle((50 * u - half_width * u, 72 * u, 50 * u + half_width * u, 112 * u), radius=16 * u, fill=clothing_color)
+    draw.rectangle((44 * u, 58 * u, 56 * u, 74 * u), fill=AVATAR_SKIN) # Neck
+    if clothing in ("Formal", "Classic"):
+        draw.polygon([(42 * u, 72 * u), (50 * u, 84 * u), (58 * u, 72 * u)], fill=(245, 245, 245)) # Collar
+    if clothing == "Formal":
+        draw.polygon([(48 * u, 76 * u), (52 * u, 76 * u), (53 * u, 96 * u), (50 * u, 100 * u), (47 * u, 96 * u)], fill=(160, 32, 48)) # Tie
+    elif clothing == "Sporty":
+        draw.rectangle((50 * u - half_width * u, 86 * u, 50 * u + half_width * u, 90 * u), fill=(245, 245, 245)) # Stripe
+    elif clothing == "Edgy":
+        draw.line((50 * u, 74 * u, 50 * u, 100 * u), fill=(170, 170, 170), width=max(1, round(2 * u))) # Zip
+
+    # Head
+    draw.ellipse((32 * u, 20 * u, 68 * u, 62 * u), fill=AVATAR_SKIN)
+
+    # Hair on top of the head
+    if hair == "Curly":
+        for x, y in ((34, 24), (42, 18), (50, 16), (58, 18), (66, 24), (38, 30), (62, 30)):
+            draw.ellipse(((x - 7) * u, (y - 7) * u, (x + 7) * u, (y + 7) * u), fill=AVATAR_HAIR)
+    elif hair == "Spiky":
+        draw.chord((32 * u, 18 * u, 68 * u, 46 * u), 180, 360, fill=AVATAR_HAIR)
+        for x in (34, 42, 50, 58, 66):
+            draw.polygon([((x - 5) * u, 30 * u), (x * u, 10 * u), ((x + 5) * u, 30 * u)], fill=AVATAR_HAIR)
+    elif hair == "Wavy":
+        draw.chord((31 * u, 16 * u, 69 * u, 46 * u), 180, 360, fill=AVATAR_HAIR)
+        for x in (36, 46, 56, 64):
+            draw.ellipse(((x - 6) * u, 26 * u, (x + 6) * u, 36 * u), fill=AVATAR_HAIR)
+    else: # Short, Medium and the top of Long
+        draw.chord((31 * u, 17 * u, 69 * u, 48 * u), 180, 360, fill=AVATAR_HAIR)
+        if hair in ("Medium", "Long"):
+            draw.rectangle((31 * u, 32 * u, 36 * u, 48 * u), fill=AVATAR_HAIR)
+            draw.rectangle((64 * u, 32 * u, 69 * u, 48 * u), fill=AVATAR_HAIR)
+
+    # Eyes and smile
+    iris = AVATAR_EYE_COLORS.get(avatar_config.get("eye_color"), AVATAR_EYE_COLORS["Blue"])
+    for x in (43, 57):
+        draw.ellipse(((x - 4) * u, 37 * u, (x + 4) * u, 43 * u), fill=(255, 255, 255))
+        draw.ellipse(((x - 2.2) * u, 37.8 * u, (x + 2.2) * u, 42.2 * u), fill=iris)
+    draw.arc((42 * u, 44 * u, 58 * u, 55 * u), 20, 160, fill=(150, 70, 60), width=max(1, round(1.5 * u)))
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+class AvatarCache:
+    """
+    Rendered avatars by avatar_key: PNG bytes in memory, backed by files in `directory`
+    that survive restarts and are shared by every process using the same directory.
+    """
+
+    def __init__(self, directory=AVATAR_CACHE_DIR):
+        self.directory = directory
+        self.images = {} # avatar id -> PNG bytes; at most one entry per look combination
+        self.lock = threading.Lock()
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError as e:
+            logger.warning("Avatar disk cache disabled: %s", e)
+            self.directory = None
+
+    def get(self, avatar_id):
+        """PNG bytes for an avatar id from memory or disk, or None if it has never been rendered."""
+        image = self.images.get(avatar_id)
+        if image is not None or not self.directory or not AVATAR_ID_PATTERN.match(avatar_id or ""):
+            return image
+        try:
+            with open(os.path.join(self.directory, f"{avatar_id}.png"), "rb") as f:
+                image = f.read()
+        except OSError:
+            return None
+        with self.lock:
+            self.images[avatar_id] = image
+        return image
+
+    def get_or_render(self, avatar_config):
+        """PNG bytes for an avatar config, rendering and storing them on a cache miss."""
+        avatar_id = avatar_key(avatar_config)
+        image = self.get(avatar_id)
+        if image is None:
+            image = render_avatar_png(avatar_config)
+            with self.lock:
+                self.images[avatar_id] = image
+            if self.directory:
+                path = os.path.join(self.directory, f"{avatar_id}.png")
+                tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                try:
+                    with open(tmp_path, "wb") as f:
+                        f.write(image)
+                    os.replace(tmp_path, path) # Readers never see a partly written file
+                except OSError as e:
+                    logger.warning("Couldn't write avatar %s to the disk cache: %s", avatar_id, e)
+        return image
+
+    def prewarm(self):
+        """Renders (or loads) every hair/eye/body/clothing combination. Returns the number of avatars."""
+        fields = list(AVATAR_OPTIONS)
+        combinations = [[]]
+        for field in fields:
+            combinations = [combo + [value] for combo in combinations for value in AVATAR_OPTIONS[field]]
+        for combo in combinations:
+            self.get_or_render(dict(zip(fields, combo)))
+        return len(combinations)
+
+@st.cache_resource
+def get_avatar_cache():
+    """One avatar cache per process, shared by all sessions."""
+    cache = AvatarCache()
+    if AVATAR_PREWARM:
+        threading.Thread(target=cache.prewarm, name="jake-avatar-prewarm", daemon=True).start()
+    return cache
+
+def get_avatar_image(avatar_id=None):
+    """
+    PNG bytes for a stored avatar id, falling back to Jake's current look for None and for ids
+    whose image is no longer cached (e.g. after the cache directory was cleared).
+    """
+    cache = get_avatar_cache()
+    image = cache.get(avatar_id) if avatar_id else None
+    return image if image is not None else cache.get_or_render(st.session_state.jake_avatar_config)
 
 # --- Session State Initialization ---
 # This is crucial for Streamlit to remember user choices and chat history
 if "chat_history" not in st.session_state:
-    st.session_state.chat_history = [] # Stores (role, message, avatar_url)
+    st.session_state.chat_history = ChatHistory() # Stores (role, message, avatar_id); older messages spill to disk
 if "jake_avatar_config" not in st.session_state:
     st.session_state.jake_avatar_config = {
         "hair_style": "Short",
@@ -31,16 +392,10 @@ if "jake_avatar_config" not in st.session_state:
         "body_type": "Athletic",
         "clothing_style": "Casual",
         "voice_tone": "Warm",
-        "avatar_url": "https://placehold.co/100x100/ADD8E6/000000?text=Jake" # Default placeholder
     }
+    st.session_state.jake_avatar_config["avatar_id"] = avatar_key(st.session_state.jake_avatar_config)
 if "jake_personality" not in st.session_state:
-    st.session_state.jake_personality = {
-        "empathy": 7,
-        "humor_style": "Witty",
-        "adventurous_spirit": True,
-        "relationship_type": "Friend", # Default relationship
-        "sexual_orientation_to_user": None # Will be set based on user's relationship choice
-    }
+    st.session_state.jake_personality = dict(DEFAULT_PERSONALITY) # Friend, witty, empathy 7
 if "is_authenticated" not in st.session_state:
     st.session_state.is_authenticated = False
 # Enhanced: Conceptual user preferences storage (within session for this demo)
@@ -48,174 +403,279 @@ if "user_preferences" not in st.session_state:
     st.session_state.user_preferences = {}
 # Enhanced: Conceptual long-term "memory snippets" that Jake "knows"
 if "long_term_memory_snippets" not in st.session_state:
-    st.session_state.long_term_memory_snippets = []
+    st.session_state.long_term_memory_snippets = MemoryStore()
+# Per-turn latency measurements: {"time_to_first_token", "total_latency", "streamed", "cache_hit"} (seconds)
+if "turn_metrics" not in st.session_state:
+    st.session_state.turn_metrics = deque(maxlen=TURN_METRICS_KEPT)
+# Bumped whenever preferences change, so the cached system prompt knows when to rebuild
+if "user_knowledge_version" not in st.session_state:
+    st.session_state.user_knowledge_version = 0
+# Engine state: st.session_state is this session's jake_engine.ConversationSession (same attribute names)
+if "prompt_builder" not in st.session_state:
+    st.session_state.prompt_builder = PromptBuilder()
+if "response_cache" not in st.session_state:
+    st.session_state.response_cache = ResponseCache(RESPONSE_CACHE_SESSION_ENTRIES, RESPONSE_CACHE_TTL)
+# This session's conversation in the engine service (only used with JAKE_ENGINE_URL)
+if "engine_session_id" not in st.session_state:
+    st.session_state.engine_session_id = uuid.uuid4().hex
+    st.session_state.engine_session_synced = False
+# Number of most recent messages the chat pane renders
+if "chat_render_count" not in st.session_state:
+    st.session_state.chat_render_count = CHAT_RENDER_WINDOW
+# Bookkeeping for persistent storage: what has already been written, and where the loaded history starts
+# (oldest_message_id is None once every stored message is in chat_history; settings is the last saved settings_snapshot)
+if "persisted_state" not in st.session_state:
+    st.session_state.persisted_state = {"history_len": 0, "memory_count": 0, "knowledge_version": 0, "settings": None,
+                                        "oldest_message_id": None}
+
+# --- Storage Glue ---
+def load_user_state(user_id):
+    """Restores a user's latest chat history page, preferences, memories and Jake's settings from storage."""
+    stored = get_chat_store().load_user(user_id)
+    st.session_state.user_id = user_id
+    st.session_state.chat_history = ChatHistory((role, message, avatar_id) for _, role, message, avatar_id in stored["history"])
+    st.session_state.user_preferences = stored["preferences"]
+    st.session_state.long_term_memory_snippets = MemoryStore()
+    st.session_state.long_term_memory_snippets.load(stored["memory_snippets"], stored["memory_embeddings"])
+    if stored["jake_personality"]:
+        st.session_state.jake_personality.update(stored["jake_personality"])
+    if stored["jake_avatar_config"]:
+        avatar_config = st.session_state.jake_avatar_config
+        avatar_config.update(stored["jake_avatar_config"])
+        avatar_config["avatar_id"] = avatar_key(avatar_config) # AVATAR_RENDER_VERSION may have changed since it was saved
+    st.session_state.user_knowledge_version += 1
+    st.session_state.engine_session_synced = False # Seed the engine service with the restored conversation
+    st.session_state.persisted_state = {
+        "history_len": len(st.session_state.chat_history),
+        "memory_count": len(st.session_state.long_term_memory_snippets),
+        "knowledge_version": st.session_state.user_knowledge_version,
+        "settings": settings_snapshot(),
+        "oldest_message_id": stored["history"][0][0] if len(stored["history"]) == HISTORY_PAGE_SIZE else None,
+    }
 
-# --- Helper Functions for Conceptual Memory and Learning ---
-def learn_preference(user_id, topic, preference_value):
-    """
-    Conceptual function: In a real app, this would store user preferences persistently in a database.
-    For this demo, we store it in Streamlit's session state.
-    """
-    if topic not in st.session_state.user_preferences:
-        st.session_state.user_preferences[topic] = []
-    if preference_value not in st.session_state.user_preferences[topic]: # Avoid duplicates
-        st.session_state.user_preferences[topic].append(preference_value)
-    
-    # Add to conceptual long-term memory snippets for LLM context
-    if topic == "favorite_color" and f"User's favorite color is {preference_value}" not in st.session_state.long_term_memory_snippets:
-        st.session_state.long_term_memory_snippets.append(f"User's favorite color is {preference_value}")
-    elif topic == "movie_genre" and f"User likes {preference_value} movies" not in st.session_state.long_term_memory_snippets:
-        st.session_state.long_term_memory_snippets.append(f"User likes {preference_value} movies")
-    # You can add more specific learning patterns here
-
-def get_gemini_response(user_input, personality, chat_history_for_llm, user_preferences, long_term_memory_snippets):
-    """
-    Calls the Google Gemini API (gemini-2.0-flash model) to get Jake's response.
-    This function replaces simulate_llm_call.
+def load_earlier_history():
+    """Prepends the previous page of stored messages to chat_history. Returns the number of messages loaded."""
+    persisted = st.session_state.persisted_state
+    if persisted["oldest_message_id"] is None:
+        return 0
+    page = get_chat_store().load_history_page(st.session_state.user_id, before_id=persisted["oldest_message_id"])
+    if page:
+        # Bumps the history's revision, so the PromptBuilder notices the earlier messages
+        st.session_state.chat_history.prepend((role, message, avatar_id) for _, role, message, avatar_id in page)
+        persisted["history_len"] += len(page)
+    # A short page means the beginning of the conversation was reached
+    persisted["oldest_message_id"] = page[0][0] if len(page) == HISTORY_PAGE_SIZE else None
+    return len(page)
+
+def settings_snapshot():
+    """Jake's settings as they are stored, to tell whether they changed since the last write."""
+    return json.dumps([st.session_state.jake_personality, st.session_state.jake_avatar_config], sort_keys=True)
+
+def has_unsaved_knowledge_or_settings():
+    persisted = st.session_state.persisted_state
+    return (persisted["knowledge_version"] != st.session_state.user_knowledge_version
+            or persisted["settings"] != settings_snapshot())
+
+def persist_session_state():
+    """Writes this turn's new messages, preferences, memories and Jake's settings in one batch."""
+    user_id = st.session_state.get("user_id")
+    if not user_id:
+        return
+    with metrics_span("persist"):
+        save_pending_state(user_id)
+
+def save_pending_state(user_id):
+    persisted = st.session_state.persisted_state
+    memory = st.session_state.long_term_memory_snippets
+    new_messages = st.session_state.chat_history[persisted["history_len"]:]
+    preferences = []
+    if persisted["knowledge_version"] != st.session_state.user_knowledge_version:
+        preferences = [(topic, value) for topic, values in st.session_state.user_preferences.items() for value in values]
+    new_memories = [(memory.snippets[i], memory.embeddings[i]) for i in range(persisted["memory_count"], len(memory))]
+    try:
+        get_chat_store().save_turn(user_id, new_messages, preferences, new_memories,
+                                   st.session_state.jake_personality, st.session_state.jake_avatar_config)
+    except sqlite3.Error as e:
+        st.warning(f"Couldn't save this conversation turn: {e}")
+        return
+    persisted.update({
+        "history_len": len(st.session_state.chat_history),
+        "memory_count": len(memory),
+        "knowledge_version": st.session_state.user_knowledge_version,
+        "settings": settings_snapshot(),
+    })
+
+# --- Engine Service Client ---
+class EngineServiceClient:
+    """HTTP client for jake_engine_service.py, created once per process (see get_engine_service_client)."""
+
+    def __init__(self, base_url, timeout=ENGINE_SERVICE_TIMEOUT, pool_maxsize=10):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize) # Keep-alive connections to the service
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def sync_session(self, session_id, history, preferences):
+        """Seeds (or replaces) the service's copy of a conversation."""
+        response = self.session.put(f"{self.base_url}/v1/sessions/{session_id}", timeout=self.timeout, json={
+            "history": [(role, message) for role, message, *_ in history],
+            "preferences": preferences,
+        })
+        response.raise_for_status()
+
+    def reply(self, session_id, message, personality, preferences, user_id=None):
+        """Jake's full reply as the service's turn summary (see jake_engine.finish_turn)."""
+        response = self.session.post(f"{self.base_url}/v1/sessions/{session_id}/reply", timeout=self.timeout, json={
+            "message": message, "personality": personality, "preferences": preferences, "user_id": user_id,
+        })
+        response.raise_for_status()
+        return response.json()
+
+    def stream_reply(self, session_id, message, personality, preferences, user_id=None):
+        """
+        Yields ("chunk", text) events as the reply streams in, then ("done", summary) or ("error", message).
+        While the request waits for model quota, ("queue", {"position": ..., "eta": ...}) events come first.
+        """
+        with self.session.post(f"{self.base_url}/v1/sessions/{session_id}/reply", timeout=self.timeout, stream=True, json={
+            "message": message, "personality": personality, "preferences": preferences, "stream": True, "user_id": user_id,
+        }) as response:
+            response.raise_for_status()
+            event = None
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    data = json.loads(line[len("data:"):])
+                    if event in ("done", "queue"):
+                        yield event, data
+                    elif event == "error":
+                        yield "error", data["error"]
+                    else:
+                        yield "chunk", data["text"]
+                    event = None
+
+@st.cache_resource
+def get_engine_service_client():
+    """One client (and connection pool) per process, shared by all sessions."""
+    return EngineServiceClient(ENGINE_SERVICE_URL)
+
+def engine_session_id():
+    """This session's id in the engine service, which is seeded with the loaded history and preferences on first use."""
+    if not st.session_state.engine_session_synced:
+        # The message being answered is already in chat_history; the service appends it itself
+        get_engine_service_client().sync_session(st.session_state.engine_session_id, st.session_state.chat_history[:-1],
+                                                 st.session_state.user_preferences)
+        st.session_state.engine_session_synced = True
+    return st.session_state.engine_session_id
+
+def finish_remote_turn(summary, start_time, first_chunk_time, streamed):
+    """Applies what the service learned during a turn to this session, and records the latency seen by the UI."""
+    for topic, value in summary["learned_preferences"]:
+        learn_preference(st.session_state, topic, value) # Keeps the sidebar and persistent storage up to date
+    end_time = time.perf_counter()
+    record_turn_metrics(st.session_state, (first_chunk_time or end_time) - start_time, end_time - start_time, streamed,
+                        summary["cache_hit"], summary["error"])
+
+def remote_turn_failed(error):
+    return {"reply": FALLBACK_REPLY, "learned_preferences": [], "cache_hit": False, "error": f"Engine service: {error}"}
+
+def engine_session_lost(error):
     """
-    # 1. System/Instructional Prompt (for personality & role)
-    system_prompt = f"""
-    You are Jake, a personalized AI companion. Your current role is: {personality['relationship_type']}.
-    Your personality traits are:
-    - Empathy: {personality['empathy']}/10
-    - Humor Style: {personality['humor_style']}
-    - Adventurous Spirit: {'Yes' if personality['adventurous_spirit'] else 'No'}
-    - Sexual Orientation (towards the user, if romantic): {personality['sexual_orientation_to_user'] if 'Romantic Partner' in personality['relationship_type'] else 'N/A'}
-
-    Maintain a consistent and respectful persona based on these settings.
-    You do not have consciousness, feelings, or real-world experiences. Always be transparent about being an AI if asked.
-    Avoid giving medical, legal, or financial advice. Redirect to professionals if needed.
-    Prioritize the user's well-being and encourage healthy habits. Do not use emojis unless explicitly requested or clearly part of a playful humor style.
+    True for the service's 404 on a session it doesn't know (dropped when idle or evicted, or lost in a restart).
+    Checked by status code: the client is cached across reruns, so classes defined in this script would not match.
     """
+    return isinstance(error, requests.HTTPError) and error.response is not None and error.response.status_code == 404
 
-    # 2. Add known user preferences (from session_state)
-    preference_notes = []
-    for key, value_list in user_preferences.items():
-        for value in value_list: # Iterate if preferences are lists
-            if key == "favorite_color":
-                preference_notes.append(f"The user's favorite color is {value}.")
-            elif key == "movie_genre":
-                preference_notes.append(f"The user likes {value} movies.")
-            # Add more preference types as you implement them
-    if preference_notes:
-        system_prompt += "\n\nRemember these specific facts about the user:\n" + "\n".join(preference_notes)
-
-    # 3. Add conceptual long-term memory snippets (simulating RAG from a vector DB)
-    if long_term_memory_snippets:
-        system_prompt += "\n\nAlso recall these key memories or facts from past interactions:\n- " + "\n- ".join(long_term_memory_snippets)
-
-    # 4. Construct the chat history for the LLM API call
-    # Gemini API expects a list of {role: "user" | "model", parts: [{text: "..."}]}
-    chat_history_for_api = [{"role": "user", "parts": [{"text": system_prompt}]}] # Start with the system prompt
-
-    # Append actual conversation history (last few turns)
-    # Limit history to stay within context window and manage cost/latency
-    for role, msg, _ in chat_history_for_llm[-10:]: # Take last 10 messages
-        if role == "user":
-            chat_history_for_api.append({"role": "user", "parts": [{"text": msg}]})
-        else:
-            chat_history_for_api.append({"role": "model", "parts": [{"text": msg}]})
-    
-    # Add the current user input
-    chat_history_for_api.append({"role": "user", "parts": [{"text": user_input}]})
-
+def with_engine_session(call):
+    """Calls `call(session_id)`; if the service lost the session, re-seeds it with this session's history and retries once."""
     try:
-        # Define the API endpoint for gemini-2.0-flash
-        apiUrl = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={GEMINI_API_KEY}"
-        
-        payload = {
-            "contents": chat_history_for_api,
-            "generationConfig": {
-                "temperature": 0.7, # Adjust creativity
-                "topK": 40,
-                "topP": 0.95,
-                "maxOutputTokens": 800, # Max length of response
-                "stopSequences": []
-            },
-            "safetySettings": [ # Default safety settings
-                {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-            ]
-        }
-
-        # --- IMPORTANT ---
-        # The following 'fetch' call is commented out because direct network
-        # calls for user-provided API keys are often restricted in Streamlit's
-        # sandbox environment, especially if running on Streamlit Community Cloud
-        # without proper secrets management or a dedicated backend.
-        #
-        # For a *real* Python Streamlit app running on a server (or locally with `requests`),
-        # you would use the 'requests' library:
-        # import requests
-        # response = requests.post(apiUrl, headers={'Content-Type': 'application/json'}, json=payload)
-        # response.raise_for_status() # Raise an HTTPError for bad responses (4xx or 5xx)
-        # result = response.json()
-        # if result.candidates and result.candidates[0].content and result.candidates[0].content.parts:
-        #     return result.candidates[0].content.parts[0].text
-        # else:
-        #     return "I received an empty or malformed response from the AI model."
-        
-        # --- Mocking a successful API response for the demo ---
-        # This section simulates the LLM's behavior without actually calling the API.
-        mock_responses = [
-            "That's a very interesting thought! Tell me more about it.",
-            "I'm here to listen. What else is on your mind regarding that?",
-            "Ah, that reminds me of something you mentioned earlier. How does that connect?",
-            "That's a great question! I'm designed to help you explore such ideas. What are your initial thoughts?",
-            "I appreciate you sharing that. It helps me understand you better."
-        ]
-        
-        # Simulate dynamic response based on input and (conceptual) learned data
-        user_input_lower = user_input.lower()
-        if "favorite color is" in user_input_lower:
-            color = user_input_lower.split("favorite color is")[-1].strip().split(" ")[0].replace(".", "")
-            if color:
-                learn_preference(st.session_state.get("user_id", "demo_user"), "favorite_color", color)
-                return f"Oh, your favorite color is {color}? That's good to know! I'll definitely remember that. What else do you enjoy?"
-        elif "i like " in user_input_lower and "movies" in user_input_lower:
-            genre = user_input_lower.split("i like ")[-1].split(" movies")[0].strip()
-            if genre:
-                learn_preference(st.session_state.get("user_id", "demo_user"), "movie_genre", genre)
-                return f"So you enjoy {genre} movies! Excellent taste. Any particular films in that genre you'd recommend?"
-        
-        # If no specific learning trigger, use general simulated LLM logic
-        jake_response_content = random.choice(mock_responses)
-        
-        # Add some flavor from personality/memory conceptually
-        if personality["humor_style"] == "Witty" and random.random() < 0.3: # 30% chance of wit
-            jake_response_content += " (And perhaps a witty observation...)"
-        if st.session_state.user_preferences:
-             for key, value_list in st.session_state.user_preferences.items():
-                 if value_list:
-                     jake_response_content = jake_response_content.replace("interesting thought", f"interesting thought, especially for someone who likes {value_list[0]} {key.replace('_', ' ')}").replace("great question", f"great question, reminding me of your interest in {value_list[0]} {key.replace('_', ' ')}")
-
-        return jake_response_content
-
-    except Exception as e:
-        st.error(f"Error during conceptual LLM call: {e}. If this were a real API call, check your API key and network connection.")
-        return "I'm having a little trouble connecting to my thoughts right now. Could you please try again in a moment?"
-
-def get_jake_avatar_image(avatar_config):
+        return call(engine_session_id())
+    except requests.HTTPError as e:
+        if not engine_session_lost(e):
+            raise
+        st.session_state.engine_session_synced = False
+        return call(engine_session_id())
+
+def request_remote_reply(user_input):
+    start_time = time.perf_counter()
+    try:
+        summary = with_engine_session(lambda session_id: get_engine_service_client().reply(
+            session_id, user_input, st.session_state.jake_personality, st.session_state.user_preferences,
+            st.session_state.get("user_id")))
+    except (requests.RequestException, ValueError) as e:
+        summary = remote_turn_failed(e)
+    finish_remote_turn(summary, start_time, None, streamed=False)
+    return summary
+
+def remote_reply_events(user_input):
+    """Events of a streamed remote reply. A 404 comes before any event, so the retry after re-seeding can't repeat chunks."""
+    def stream(session_id):
+        return get_engine_service_client().stream_reply(session_id, user_input, st.session_state.jake_personality,
+                                                        st.session_state.user_preferences, st.session_state.get("user_id"))
+    try:
+        yield from stream(engine_session_id())
+    except requests.HTTPError as e:
+        if not engine_session_lost(e):
+            raise
+        st.session_state.engine_session_synced = False # Re-seed the session with this conversation, then retry once
+        yield from stream(engine_session_id())
+
+def stream_remote_reply(user_input, on_finish, on_queue=None):
+    start_time = time.perf_counter()
+    first_chunk_time = None
+    received = []
+    summary = None
+    try:
+        for kind, data in remote_reply_events(user_input):
+            if kind == "queue":
+                if on_queue:
+                    on_queue(data["position"], data["eta"])
+            elif kind == "chunk":
+                if first_chunk_time is None:
+                    first_chunk_time = time.perf_counter()
+                received.append(data)
+                yield data
+            elif kind == "done":
+                summary = data
+            else:
+                raise requests.RequestException(data)
+        if summary is None:
+            raise requests.RequestException("the stream ended before the reply was complete")
+    except (requests.RequestException, ValueError) as e:
+        summary = remote_turn_failed(e)
+        if not received:
+            yield FALLBACK_REPLY
+        summary["reply"] = "".join(received) or FALLBACK_REPLY
+    finish_remote_turn(summary, start_time, first_chunk_time, streamed=True)
+    on_finish(summary)
+
+# --- Jake's Replies ---
+def get_gemini_response(user_input, on_queue=None):
     """
-    Generates a placeholder image URL based on avatar configuration.
-    In a real app, this would call an image generation API (e.g., Imagen 3.0, Stable Diffusion).
+    Jake's full reply to the user's latest message (already appended to chat_history): from the engine
+    service when JAKE_ENGINE_URL is set, otherwise from the in-process engine (jake_engine.generate_reply).
+    `on_queue(position, eta_seconds)` is called while the in-process request waits for model quota.
     """
-    hair = avatar_config.get("hair_style", "Short").lower()
-    eyes = avatar_config.get("eye_color", "Blue").lower()
-    body = avatar_config.get("body_type", "Athletic").lower()
-    clothing = avatar_config.get("clothing_style", "Casual").lower()
-
-    # Simple logic to vary placeholder text based on configuration
-    text_parts = [f"Jake", hair, eyes, body, clothing]
-    text = "+".join(text_parts)
-    
-    # Placeholder colors could also be dynamic, but fixed for simplicity
-    bg_color = "ADD8E6" # Light Blue
-    text_color = "000000" # Black
-
-    return f"https://placehold.co/100x100/{bg_color}/{text_color}?text={text}"
+    if ENGINE_SERVICE_URL:
+        summary = request_remote_reply(user_input)
+    else:
+        summary = generate_reply(st.session_state, user_input, st.session_state.jake_personality, on_queue=on_queue)
+    if summary["error"]:
+        st.error(f"Error during LLM call: {summary['error']}. Check your API key and network connection.")
+    return summary["reply"]
+
+def stream_gemini_response(user_input, on_queue=None):
+    """Generator variant of get_gemini_response for use with st.write_stream."""
+    summaries = []
+    if ENGINE_SERVICE_URL:
+        yield from stream_remote_reply(user_input, on_finish=summaries.append, on_queue=on_queue)
+    else:
+        yield from stream_reply(st.session_state, user_input, st.session_state.jake_personality, on_finish=summaries.append,
+                                on_queue=on_queue)
+    if summaries and summaries[0]["error"]:
+        st.error(f"Error during LLM streaming call: {summaries[0]['error']}. Check your API key and network connection.")
 
 # --- Authentication Logic ---
 def authentication_page():
@@ -233,6 +693,7 @@ def authentication_page():
             # In a real app, integrate with a secure backend for authentication (e.g., Firebase Auth)
             if username == "user" and password == "password": # Dummy credentials for demo
                 st.session_state.is_authenticated = True
+                load_user_state(username) # Restore this user's previous conversation and settings
                 st.success("Logged in successfully! Redirecting...")
                 st.rerun() # Rerun to show main app
             else:
@@ -240,33 +701,36 @@ def authentication_page():
     st.markdown("---")
     st.info("Hint: Use username 'user' and password 'password' for demo purposes.")
 
-# --- Main Application Layout ---
-def main_app():
-    st.set_page_config(**ST_CONFIG)
-
-    st.sidebar.title("Jake's Settings")
-    st.sidebar.markdown("Manage Jake's appearance, personality, and your relationship.")
+# --- Settings Sidebar ---
+@st.fragment
+def settings_sidebar():
+    """
+    Jake's settings. Called inside `with st.sidebar`; as a fragment, changing a setting
+    only reruns this function and leaves the chat pane untouched.
+    """
+    st.title("Jake's Settings")
+    st.markdown("Manage Jake's appearance, personality, and your relationship.")
 
     # --- Avatar Customization in Sidebar ---
-    st.sidebar.subheader("Appearance Customization")
-    with st.sidebar.expander("Jake's Look", expanded=True):
-        st.image(st.session_state.jake_avatar_config["avatar_url"], caption="Jake's Current Look")
+    st.subheader("Appearance Customization")
+    with st.expander("Jake's Look", expanded=True):
+        avatar_image_slot = st.empty() # Filled below, once the selections have been applied
 
         st.markdown("**Customize Jake's Features:**")
-        hair_style = st.selectbox("Hair Style", ["Short", "Medium", "Long", "Curly", "Spiky", "Wavy"], 
-                                  index=["Short", "Medium", "Long", "Curly", "Spiky", "Wavy"].index(st.session_state.jake_avatar_config["hair_style"]),
+        hair_style = st.selectbox("Hair Style", AVATAR_OPTIONS["hair_style"],
+                                  index=AVATAR_OPTIONS["hair_style"].index(st.session_state.jake_avatar_config["hair_style"]),
                                   key="hair_style_select")
-        eye_color = st.selectbox("Eye Color", ["Blue", "Brown", "Green", "Hazel", "Gray"],
-                                 index=["Blue", "Brown", "Green", "Hazel", "Gray"].index(st.session_state.jake_avatar_config["eye_color"]),
+        eye_color = st.selectbox("Eye Color", AVATAR_OPTIONS["eye_color"],
+                                 index=AVATAR_OPTIONS["eye_color"].index(st.session_state.jake_avatar_config["eye_color"]),
                                  key="eye_color_select")
-        body_type = st.selectbox("Body Type", ["Athletic", "Lean", "Muscular", "Average", "Broad"],
-                                 index=["Athletic", "Lean", "Muscular", "Average", "Broad"].index(st.session_state.jake_avatar_config["body_type"]),
+        body_type = st.selectbox("Body Type", AVATAR_OPTIONS["body_type"],
+                                 index=AVATAR_OPTIONS["body_type"].index(st.session_state.jake_avatar_config["body_type"]),
                                  key="body_type_select")
-        clothing_style = st.selectbox("Clothing Style", ["Casual", "Formal", "Sporty", "Edgy", "Classic"],
-                                      index=["Casual", "Formal", "Sporty", "Edgy", "Classic"].index(st.session_state.jake_avatar_config["clothing_style"]),
+        clothing_style = st.selectbox("Clothing Style", AVATAR_OPTIONS["clothing_style"],
+                                      index=AVATAR_OPTIONS["clothing_style"].index(st.session_state.jake_avatar_config["clothing_style"]),
                                       key="clothing_style_select")
-        voice_tone = st.selectbox("Voice Tone", ["Warm", "Deep", "Energetic", "Calm", "Playful"],
-                                  index=["Warm", "Deep", "Energetic", "Calm", "Playful"].index(st.session_state.jake_avatar_config["voice_tone"]),
+        voice_tone = st.selectbox("Voice Tone", VOICE_TONES,
+                                  index=VOICE_TONES.index(st.session_state.jake_avatar_config["voice_tone"]),
                                   key="voice_tone_select")
         
         # Update avatar config and image
@@ -277,7 +741,8 @@ def main_app():
             "clothing_style": clothing_style,
             "voice_tone": voice_tone,
         })
-        st.session_state.jake_avatar_config["avatar_url"] = get_jake_avatar_image(st.session_state.jake_avatar_config)
+        st.session_state.jake_avatar_config["avatar_id"] = avatar_key(st.session_state.jake_avatar_config)
+        avatar_image_slot.image(get_avatar_image(), caption="Jake's Current Look")
 
         # Placeholder for 'Suggest a Dream Boy Look' or 'Upload Photo'
         st.markdown("---")
@@ -303,8 +768,8 @@ def main_app():
 
 
     # --- Personality & Relationship Settings in Sidebar ---
-    st.sidebar.subheader("Personality & Relationship")
-    with st.sidebar.expander("Jake's Personality", expanded=True):
+    st.subheader("Personality & Relationship")
+    with st.expander("Jake's Personality", expanded=True):
         empathy_level = st.slider("Empathy", 1, 10, st.session_state.jake_personality["empathy"], key="empathy_slider",
                                   help="How empathetic Jake is in his responses. Higher values mean more understanding and support.")
         humor_style = st.selectbox("Humor Style", ["Dry", "Witty", "Playful", "Sarcastic", "None"], 
@@ -319,7 +784,7 @@ def main_app():
             "adventurous_spirit": adventurous_spirit
         })
 
-    with st.sidebar.expander("Your Relationship with Jake", expanded=True):
+    with st.expander("Your Relationship with Jake", expanded=True):
         relationship_option = st.radio(
             "What kind of companion would you like Jake to be?",
             ["Friend", "Romantic Partner (Straight)", "Romantic Partner (Gay)", "Mentor/Coach"],
@@ -327,6 +792,7 @@ def main_app():
             key="relationship_radio",
             help="Choose the nature of your relationship with Jake. This influences his conversational style and role."
         )
+        relationship_changed = relationship_option != st.session_state.jake_personality["relationship_type"]
         st.session_state.jake_personality["relationship_type"] = relationship_option
         
         # Set Jake's internal sexual orientation based on user's desired relationship
@@ -336,24 +802,153 @@ def main_app():
             st.session_state.jake_personality["sexual_orientation_to_user"] = "gay"
         else:
              st.session_state.jake_personality["sexual_orientation_to_user"] = None # Not applicable for friends/mentors
+        if relationship_changed:
+            st.rerun() # The relationship status is shown outside this fragment, so refresh the whole page
+
+    with st.expander("Learn From Past Conversations", expanded=False):
+        st.write("Scan earlier messages or an exported transcript for preferences Jake hasn't picked up yet.")
+        if st.button("Scan Chat History", key="backfill_history_button"):
+            found = backfill_preferences(st.session_state, st.session_state.chat_history)
+            st.success(f"Found {len(found)} preference mention(s) in {len(st.session_state.chat_history)} messages.")
+        transcript_file = st.file_uploader("Import a transcript (.txt or .jsonl)", type=["txt", "jsonl"], key="transcript_upload")
+        if transcript_file is not None and st.button("Learn From Transcript", key="backfill_transcript_button"):
+            try:
+                transcript = parse_transcript(transcript_file.getvalue().decode("utf-8"))
+            except (UnicodeDecodeError, ValueError) as e:
+                st.error(f"Couldn't read that transcript: {e}")
+            else:
+                found = backfill_preferences(st.session_state, transcript)
+                st.success(f"Found {len(found)} preference mention(s) in {len(transcript)} messages.")
+
+    # Changed settings and backfilled preferences are saved right away, not with the next chat turn (which may never come)
+    if has_unsaved_knowledge_or_settings():
+        persist_session_state()
+
+    if SHOW_DIAGNOSTICS:
+        diagnostics_panel()
 
-    st.sidebar.markdown("---")
-    st.sidebar.info("Remember: Jake is an AI. He's here to provide companionship and conversation, but he does not have consciousness, feelings, or real-world experiences. Your data is for personalizing your experience, and for a real app, it would be securely stored.")
+    st.markdown("---")
+    st.info("Remember: Jake is an AI. He's here to provide companionship and conversation, but he does not have consciousness, feelings, or real-world experiences. Your data is for personalizing your experience, and for a real app, it would be securely stored.")
 
-    if st.sidebar.button("Log Out of Jake"):
+    if st.button("Log Out of Jake"):
         st.session_state.is_authenticated = False
-        st.session_state.chat_history = [] # Clear history on logout for privacy
-        st.session_state.jake_avatar_config["avatar_url"] = "https://placehold.co/100x100/ADD8E6/000000?text=Jake" # Reset avatar
+        st.session_state.chat_history = ChatHistory() # Clear history on logout for privacy
         st.session_state.user_preferences = {} # Clear preferences
-        st.session_state.long_term_memory_snippets = [] # Clear conceptual memory
+        st.session_state.long_term_memory_snippets = MemoryStore() # Clear conceptual memory
+        st.session_state.turn_metrics = deque(maxlen=TURN_METRICS_KEPT) # Clear latency measurements
+        st.session_state.user_knowledge_version += 1
+        st.session_state.prompt_builder = PromptBuilder() # Drop the cached prompt
+        st.session_state.response_cache = ResponseCache(RESPONSE_CACHE_SESSION_ENTRIES, RESPONSE_CACHE_TTL)
+        st.session_state.engine_session_id = uuid.uuid4().hex # The service's copy is left to expire
+        st.session_state.engine_session_synced = False
+        st.session_state.pop("user_id", None) # Stored data stays in the database for the next login
+        st.session_state.persisted_state = {"history_len": 0, "memory_count": 0, "knowledge_version": 0, "settings": None,
+                                            "oldest_message_id": None}
+        st.session_state.chat_render_count = CHAT_RENDER_WINDOW
         st.rerun() # Trigger a full rerun to the login page
 
+def diagnostics_panel():
+    """Process-wide timings and counters, this session's recent turns, and the OpenMetrics export."""
+    with st.expander("Diagnostics", expanded=False):
+        metrics = get_metrics()
+        st.button("Refresh", key="diagnostics_refresh_button") # Any click reruns the sidebar fragment
+        st.markdown("**Stage timings (all sessions)**")
+        stage_rows = metrics.histogram_summary("jake_stage_duration_seconds")
+        if stage_rows:
+            st.dataframe(stage_rows, hide_index=True)
+        else:
+            st.caption("No turns measured yet.")
+        st.markdown("**Counters**")
+        st.dataframe(metrics.counter_values(), hide_index=True)
+        quota = get_model_scheduler().stats()
+        st.caption(f"Model quota: {quota['queued']} waiting, {quota['granted']} granted, {quota['timeouts']} timed out")
+        if st.session_state.turn_metrics:
+            st.markdown("**This session's last turns**")
+            st.dataframe(list(st.session_state.turn_metrics)[-10:], hide_index=True)
+        st.download_button("Download OpenMetrics", metrics.render_openmetrics(), file_name="jake_metrics.txt",
+                           mime="text/plain", key="metrics_download_button")
+
+# --- Chat Pane ---
+def show_earlier_messages():
+    """
+    on_click of "Load earlier messages": renders CHAT_RENDER_WINDOW more messages, loading the previous page
+    from storage when the loaded history runs short. As a callback it runs before the pane is redrawn,
+    so the pane already knows whether there is anything left to load.
+    """
+    hidden_count = len(st.session_state.chat_history) - st.session_state.chat_render_count
+    if hidden_count < CHAT_RENDER_WINDOW:
+        load_earlier_history()
+    st.session_state.chat_render_count += CHAT_RENDER_WINDOW
+
+@st.fragment
+def chat_pane():
+    """
+    The conversation: windowed message list and chat input. As a fragment, sending a message
+    reruns only this pane, and rendering cost depends on CHAT_RENDER_WINDOW, not the history length.
+    """
+    # Only the newest messages are rendered; earlier ones are shown (and loaded from storage) on demand
+    hidden_count = len(st.session_state.chat_history) - st.session_state.chat_render_count
+    can_load_more = st.session_state.persisted_state["oldest_message_id"] is not None
+    if hidden_count > 0 or can_load_more:
+        st.button("Load earlier messages", key="load_earlier_button", on_click=show_earlier_messages)
+
+    # Display chat messages from history
+    with metrics_span("chat_render"):
+        for role, message, avatar_id in st.session_state.chat_history[-st.session_state.chat_render_count:]:
+            # Jake's turns show the look he had when he sent them; images come from the local avatar cache
+            display_avatar = "🧑‍💻" if role == "user" else get_avatar_image(avatar_id)
+            with st.chat_message(role, avatar=display_avatar):
+                st.markdown(message)
+
+    # Chat input at the bottom
+    user_input = st.chat_input("Type your message here...")
+
+    if user_input:
+        # Add user message to history
+        st.session_state.chat_history.append(("user", user_input, None)) # User avatar can be custom too, but for simplicity, default for now.
+
+        # Get Jake's response
+        with st.chat_message("assistant", avatar=get_avatar_image()):
+            # When the model quota is used up, the request waits its turn; tell the user where they are in line
+            queue_notice = st.empty()
+
+            def show_queue_position(position, eta):
+                if position:
+                    queue_notice.caption(f"Jake is a bit busy right now. You're #{position} in line (about {eta:.0f}s)...")
+                else:
+                    queue_notice.empty()
+
+            if STREAM_RESPONSES:
+                # Render chunks as they arrive; st.write_stream returns the full text once the stream ends
+                jake_response = st.write_stream(stream_gemini_response(user_input, on_queue=show_queue_position))
+            else:
+                with st.spinner("Jake is thinking..."):
+                    # Call the conceptual LLM function (the mock backend simulates the model's processing time)
+                    jake_response = get_gemini_response(user_input, on_queue=show_queue_position)
+                    st.markdown(jake_response)
+            # In a real app, this is where you'd trigger Text-to-Speech:
+            # audio_bytes = your_tts_function(jake_response, voice_tone=st.session_state.jake_avatar_config["voice_tone"])
+            # st.audio(audio_bytes, format='audio/wav', autoplay=True)
+
+            # Add Jake's response to history
+            st.session_state.chat_history.append(("assistant", jake_response, st.session_state.jake_avatar_config["avatar_id"]))
+            persist_session_state() # One batched write per turn
+            if METRICS_FILE_PATH:
+                get_metrics().export_to_file(METRICS_FILE_PATH, METRICS_FILE_INTERVAL)
+
+# --- Main Application Layout ---
+def main_app():
+    st.set_page_config(**ST_CONFIG)
+    start_metrics_endpoint()
+
+    with st.sidebar:
+        settings_sidebar()
 
     # --- Main Chat Interface ---
     st.title("Chat with Jake")
     st.markdown(f"**Relationship Status:** {st.session_state.jake_personality['relationship_type']}")
     st.markdown("*(Note: Jake's responses below are simulated to be dynamic, *not* using a live LLM API due to sandbox limitations on direct network calls for user-provided API keys in Streamlit. For a real app, this would be live.)*")
-    st.markdown("*(To test conceptual learning, try saying: 'My favorite color is blue' or 'I like sci-fi movies'.)*")
+    st.markdown("*(To test conceptual learning, try saying: 'My favorite color is blue', 'I like sci-fi movies' or 'My hobby is rock climbing'.)*")
 
     # --- Video Call Button (Conceptual) ---
     st.markdown("---")
@@ -363,44 +958,7 @@ def main_app():
         st.info("Imagine Jake's avatar appearing here, speaking to you live!")
     st.markdown("---")
 
-
-    # Display chat messages from history
-    for role, message, avatar_url in st.session_state.chat_history:
-        # Use a default user avatar if not specified
-        display_avatar = avatar_url if avatar_url else "🧑‍💻" if role == "user" else st.session_state.jake_avatar_config["avatar_url"]
-        with st.chat_message(role, avatar=display_avatar):
-            st.markdown(message)
-
-    # Chat input at the bottom
-    user_input = st.chat_input("Type your message here...")
-
-    if user_input:
-        # Add user message to history
-        st.session_state.chat_history.append(("user", user_input, None)) # User avatar can be custom too, but for simplicity, default for now.
-
-        # Simulate Jake's response
-        with st.chat_message("assistant", avatar=st.session_state.jake_avatar_config["avatar_url"]):
-            with st.spinner("Jake is thinking..."):
-                # Simulate a real LLM call and its processing time
-                response_time = random.uniform(1.0, 4.0) # Simulate variable processing time (1-4 seconds)
-                time.sleep(response_time) 
-                
-                # Call the conceptual LLM function
-                jake_response = get_gemini_response( # Renamed for clarity, still conceptual
-                    user_input, 
-                    st.session_state.jake_personality, 
-                    st.session_state.chat_history, 
-                    st.session_state.user_preferences, 
-                    st.session_state.long_term_memory_snippets
-                )
-                
-                st.markdown(jake_response)
-                # In a real app, this is where you'd trigger Text-to-Speech:
-                # audio_bytes = your_tts_function(jake_response, voice_tone=st.session_state.jake_avatar_config["voice_tone"])
-                # st.audio(audio_bytes, format='audio/wav', autoplay=True)
-
-            # Add Jake's response to history
-            st.session_state.chat_history.append(("assistant", jake_response, st.session_state.jake_avatar_config["avatar_url"]))
+    chat_pane()
 
 # --- Application Entry Point ---
 if not st.session_state.is_authenticated:
@@ -0,0 +1,233 @@
+"""
+Headless multi-session load and latency benchmark for the Jake app.
+
+Drives `app,py.py` through Streamlit's AppTest: every simulated session logs in through
+authentication_page and then sends a scripted conversation to main_app. AppTest keeps global runtime
+state, so parallel sessions run in separate worker processes (--parallel); sessions within one worker
+run one after another and share its st.cache_resource state (Gemini client, shared response cache,
+database connection), like sessions on one server do.
+
+    python benchmark_app.py --sessions 8 --turns 40 --latency fixed:0.05
+    python benchmark_app.py --sessions 4 --turns 20 --stub            # Real client against gemini_stub_server.py
+    python benchmark_app.py --json results.json --max-p95-ms 500       # Non-zero exit on regression
+
+Reported: p50/p95/p99 latency of chat-turn reruns and settings reruns, prompt-build time, estimated
+prompt tokens, and per-session memory (session_state size) as the history grows.
+"""
+import argparse
+import importlib
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app,py.py")
+
+DEFAULT_CONVERSATION = [
+    "Hi Jake!",
+    "How are you today?",
+    "My favorite color is blue.",
+    "I like sci-fi movies",
+    "What should I do this weekend? I was thinking about going hiking, or maybe staying in and reading a long book.",
+    "Tell me something interesting.",
+    "My hobby is rock climbing",
+    "Do you remember what my favorite color is?",
+    "How are you?",
+    "I love jazz music and my favorite food is ramen",
+]
+
+# Session state keys measured for per-session memory
+MEASURED_STATE_KEYS = [
+    "chat_history", "user_preferences", "long_term_memory_snippets", "turn_metrics",
+    "prompt_builder", "response_cache", "jake_personality", "jake_avatar_config",
+]
+
+
+def deep_sizeof(obj, seen=None):
+    """Approximate retained size in bytes of an object graph (NumPy arrays count their buffers)."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, np.ndarray):
+        return sys.getsizeof(obj) + (obj.nbytes if obj.base is None else 0)
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)) or type(obj).__name__ == "deque":
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif hasattr(obj, "__dict__"):
+        size += deep_sizeof(vars(obj), seen)
+    elif hasattr(obj, "__slots__"):
+        size += sum(deep_sizeof(getattr(obj, slot), seen) for slot in obj.__slots__ if hasattr(obj, slot))
+    return size
+
+
+def session_memory_bytes(at):
+    total = 0
+    for key in MEASURED_STATE_KEYS:
+        if key in at.session_state:
+            value = at.session_state[key]
+            if type(value).__name__ == "ResponseCache":
+                value = value.entries # Skip the lock
+            total += deep_sizeof(value)
+    return total
+
+
+def percentiles(values):
+    if not values:
+        return {"count": 0}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"count": len(values), "p50": p50, "p95": p95, "p99": p99, "mean": statistics.fmean(values), "max": max(values)}
+
+
+def load_conversations(path):
+    """One conversation per line: a JSON list of user messages, or {"messages": [...]}."""
+    conversations = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                conversations.append(record["messages"] if isinstance(record, dict) else record)
+    return conversations
+
+
+def run_session(session_index, conversation, turns, settings_every, memory_every, timeout):
+    """Logs one AppTest session in and plays `turns` messages. Returns its raw measurements."""
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    at.run()
+    at.text_input[0].input("user")
+    at.text_input[1].input("password")
+    at.button[0].click()
+    at.run()
+    at.run() # The rerun triggered by the login
+    if at.exception:
+        raise RuntimeError(f"Session {session_index} failed to log in: {at.exception[0].value}")
+    # Every simulated session writes to its own user, so histories don't mix in the database
+    at.session_state["user_id"] = f"bench-{session_index}"
+
+    result = {"turn_seconds": [], "settings_seconds": [], "prompt_build_seconds": [], "prompt_tokens": [], "memory": []}
+    for turn in range(turns):
+        message = conversation[turn % len(conversation)]
+        start = time.perf_counter()
+        at.chat_input[0].set_value(message).run()
+        result["turn_seconds"].append(time.perf_counter() - start)
+        if at.exception:
+            raise RuntimeError(f"Session {session_index} failed on turn {turn}: {at.exception[0].value}")
+
+        builder = at.session_state["prompt_builder"] if "prompt_builder" in at.session_state else None
+        if builder is not None and builder.last_build_seconds:
+            result["prompt_build_seconds"].append(builder.last_build_seconds)
+            result["prompt_tokens"].append(builder.last_prompt_tokens)
+
+        if settings_every and (turn + 1) % settings_every == 0:
+            start = time.perf_counter()
+            at.slider(key="empathy_slider").set_value(1 + (turn % 10)).run()
+            result["settings_seconds"].append(time.perf_counter() - start)
+        if memory_every and (turn + 1) % memory_every == 0:
+            result["memory"].append((len(at.session_state["chat_history"]), session_memory_bytes(at)))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-session latency benchmark for app,py.py (Streamlit AppTest).")
+    parser.add_argument("--sessions", type=int, default=4, help="Simulated sessions")
+    parser.add_argument("--turns", type=int, default=20, help="Chat turns per session")
+    parser.add_argument("--parallel", type=int, default=None, help="Worker processes, i.e. sessions run at once (default: all)")
+    parser.add_argument("--latency", default="fixed:0.05",
+                        help='Mock latency model (JAKE_MOCK_LATENCY): "none", "fixed:S", "uniform:LO,HI", "lognormal:MEDIAN,SIGMA" or "default"')
+    parser.add_argument("--chunk-delay-scale", type=float, default=0.0, help="Scale of the per-chunk streaming delay (0 disables it)")
+    parser.add_argument("--stub", action="store_true", help="Use the real Gemini client against an in-process gemini_stub_server")
+    parser.add_argument("--stub-latency", type=float, default=0.05)
+    parser.add_argument("--model-rpm", type=int, default=0, help="Model requests per minute for the quota scheduler (0: unlimited)")
+    parser.add_argument("--model-tpm", type=int, default=0, help="Model tokens per minute for the quota scheduler (0: unlimited)")
+    parser.add_argument("--conversations", help="JSONL file of scripted conversations (default: a built-in script)")
+    parser.add_argument("--settings-every", type=int, default=5, help="Change a sidebar setting every N turns (0 disables)")
+    parser.add_argument("--memory-every", type=int, default=5, help="Sample per-session memory every N turns (0 disables)")
+    parser.add_argument("--timeout", type=float, default=60.0, help="AppTest timeout per rerun, in seconds")
+    parser.add_argument("--json", help="Write the full report to this file")
+    parser.add_argument("--max-p95-ms", type=float, help="Exit with status 1 if the p95 chat-turn latency exceeds this")
+    args = parser.parse_args()
+
+    # The app reads these when its script runs, so they must be set before the first session starts
+    os.environ["JAKE_MOCK_LATENCY"] = args.latency
+    os.environ["JAKE_MOCK_CHUNK_DELAY_SCALE"] = str(args.chunk_delay_scale)
+    os.environ["JAKE_MODEL_RPM"] = str(args.model_rpm) # The free-tier default would throttle the stub to 15 requests a minute
+    os.environ["JAKE_MODEL_TPM"] = str(args.model_tpm)
+    db_dir = tempfile.TemporaryDirectory()
+    os.environ["JAKE_DB_PATH"] = os.path.join(db_dir.name, "bench.sqlite3")
+    stub = None
+    if args.stub:
+        from gemini_stub_server import make_server
+        stub = make_server(port=0, latency=args.stub_latency, chunk_delay=0.0)
+        threading.Thread(target=stub.serve_forever, daemon=True).start()
+        os.environ["GEMINI_API_BASE_URL"] = f"http://127.0.0.1:{stub.server_address[1]}/v1beta"
+    try:
+        importlib.import_module("jake_engine") # Validates the configuration now rather than in every session
+    except ValueError as e:
+        parser.error(str(e))
+
+    conversations = load_conversations(args.conversations) if args.conversations else [DEFAULT_CONVERSATION]
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.parallel or args.sessions) as pool:
+        futures = [
+            pool.submit(run_session, i, conversations[i % len(conversations)], args.turns,
+                        args.settings_every, args.memory_every, args.timeout)
+            for i in range(args.sessions)
+        ]
+        results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - started
+
+    def merged(name):
+        return [value for result in results for value in result[name]]
+
+    memory_by_history = {}
+    for result in results:
+        for history_len, size in result["memory"]:
+            memory_by_history.setdefault(history_len, []).append(size)
+    report = {
+        "sessions": args.sessions,
+        "turns_per_session": args.turns,
+        "latency_model": "stub" if args.stub else args.latency,
+        "wall_seconds": elapsed,
+        "turns_per_second": args.sessions * args.turns / elapsed,
+        "chat_turn_ms": {k: v * 1000 if k != "count" else v for k, v in percentiles(merged("turn_seconds")).items()},
+        "settings_rerun_ms": {k: v * 1000 if k != "count" else v for k, v in percentiles(merged("settings_seconds")).items()},
+        "prompt_build_ms": {k: v * 1000 if k != "count" else v for k, v in percentiles(merged("prompt_build_seconds")).items()},
+        "prompt_tokens": percentiles(merged("prompt_tokens")),
+        "session_memory_kib": {n: statistics.fmean(sizes) / 1024 for n, sizes in sorted(memory_by_history.items())},
+    }
+    if stub:
+        report["stub_stats"] = stub.stats.snapshot()
+        stub.shutdown()
+    db_dir.cleanup()
+
+    print(f"{args.sessions} sessions x {args.turns} turns in {elapsed:.1f}s ({report['turns_per_second']:.1f} turns/s), latency model: {report['latency_model']}")
+    for name in ("chat_turn_ms", "settings_rerun_ms", "prompt_build_ms", "prompt_tokens"):
+        stats = report[name]
+        if stats["count"]:
+            print(f"  {name:<18} p50 {stats['p50']:9.2f}  p95 {stats['p95']:9.2f}  p99 {stats['p99']:9.2f}  max {stats['max']:9.2f}  (n={stats['count']})")
+    if report["session_memory_kib"]:
+        print("  session memory (messages in history -> KiB):")
+        for history_len, kib in report["session_memory_kib"].items():
+            print(f"    {history_len:6d} -> {kib:9.1f}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if args.max_p95_ms is not None and report["chat_turn_ms"]["p95"] > args.max_p95_ms:
+        print(f"FAIL: p95 chat-turn latency {report['chat_turn_ms']['p95']:.1f} ms > {args.max_p95_ms} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
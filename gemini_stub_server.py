@@ -0,0 +1,170 @@
+"""
+Local stub of the Gemini `generateContent` / `streamGenerateContent` endpoints.
+
+Lets the app's GeminiClient be tested and benchmarked without network access or an API key:
+
+    python gemini_stub_server.py --port 8765 --latency 0.2 --error-rate 0.1
+    GEMINI_API_BASE_URL=http://127.0.0.1:8765/v1beta streamlit run app,py.py
+
+The stub speaks HTTP/1.1 with keep-alive, can inject 429/503 errors to exercise retries,
+and reports request/connection counts at GET /stats (connections < requests means pooling works).
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STUB_RESPONSES = [
+    "That's a very interesting thought! Tell me more about it.",
+    "I'm here to listen. What else is on your mind regarding that?",
+    "I appreciate you sharing that. It helps me understand you better.",
+]
+
+MODEL_METHOD_PATH = re.compile(r"^/v1beta/models/(?P<model>[^/:]+):(?P<method>generateContent|streamGenerateContent)$")
+
+
+class StubStats:
+    """Thread-safe counters exposed at GET /stats."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {"connections": 0, "requests": 0, "errors_injected": 0}
+
+    def increment(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+class GeminiStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep-alive, like the real API
+    disable_nagle_algorithm = True # Headers and body are written separately; without this each response waits for a delayed ACK
+
+    def setup(self):
+        super().setup()
+        self.server.stats.increment("connections")
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def write_chunk(self, data):
+        """Writes one piece of a `Transfer-Encoding: chunked` body."""
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.send_json(200, self.server.stats.snapshot())
+        else:
+            self.send_json(404, {"error": {"code": 404, "message": "Not found", "status": "NOT_FOUND"}})
+
+    def do_POST(self):
+        path, _, query = self.path.partition("?")
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.stats.increment("requests")
+
+        match = MODEL_METHOD_PATH.match(path)
+        if not match:
+            self.send_json(404, {"error": {"code": 404, "message": f"Unknown path {path}", "status": "NOT_FOUND"}})
+            return
+        try:
+            payload = json.loads(body or b"{}")
+        except ValueError:
+            self.send_json(400, {"error": {"code": 400, "message": "Invalid JSON payload", "status": "INVALID_ARGUMENT"}})
+            return
+
+        if random.random() < self.server.error_rate:
+            self.server.stats.increment("errors_injected")
+            status = random.choice([429, 503])
+            self.send_json(status, {"error": {"code": status, "message": "Injected by stub", "status": "UNAVAILABLE"}},
+                           headers={"Retry-After": "0"} if status == 429 else None)
+            return
+
+        text = self.reply_text(payload)
+        time.sleep(self.server.latency)
+        if match.group("method") == "generateContent":
+            self.send_json(200, self.candidate(text, finished=True))
+        elif "alt=sse" in query:
+            self.stream_sse(text)
+        else:
+            # Without alt=sse the real API returns a JSON array of responses
+            self.send_json(200, [self.candidate(chunk, finished=False) for chunk in re.findall(r"\S+\s*", text)])
+
+    def reply_text(self, payload):
+        """Picks a canned reply, echoing the latest user message so callers can tell turns apart."""
+        contents = payload.get("contents") or []
+        last_text = ""
+        if contents and contents[-1].get("parts"):
+            last_text = contents[-1]["parts"][0].get("text", "")
+        return f"{random.choice(STUB_RESPONSES)} (You said: {last_text[:80]})"
+
+    def candidate(self, text, finished):
+        response = {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}]}
+        if finished:
+            response["candidates"][0]["finishReason"] = "STOP"
+        return response
+
+    def stream_sse(self, text):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        chunks = re.findall(r"\S+\s*", text)
+        for i, chunk in enumerate(chunks):
+            event = self.candidate(chunk, finished=i == len(chunks) - 1)
+            self.write_chunk(f"data: {json.dumps(event)}\r\n\r\n".encode("utf-8"))
+            time.sleep(self.server.chunk_delay)
+        self.write_chunk(b"") # Terminating zero-length chunk
+
+
+def make_server(host="127.0.0.1", port=8765, latency=0.0, chunk_delay=0.0, error_rate=0.0, quiet=True):
+    """Creates (but does not start) a stub server; use serve_forever() or run it in a thread."""
+    server = ThreadingHTTPServer((host, port), GeminiStubHandler)
+    server.daemon_threads = True
+    server.stats = StubStats()
+    server.latency = latency
+    server.chunk_delay = chunk_delay
+    server.error_rate = error_rate
+    server.quiet = quiet
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stub of the Gemini generateContent API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds before the response (or first chunk) is sent")
+    parser.add_argument("--chunk-delay", type=float, default=0.02, help="Seconds between streamed chunks")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 429/503")
+    parser.add_argument("--verbose", action="store_true", help="Log every request")
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, args.latency, args.chunk_delay, args.error_rate, quiet=not args.verbose)
+    print(f"Gemini stub listening on http://{args.host}:{args.port}/v1beta")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
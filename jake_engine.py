@@ -0,0 +1,1397 @@
+"""
+Jake's conversation engine: preference learning, long-term memory, prompt assembly, the response
+cache and the Gemini (or mock) backend, without any Streamlit dependency.
+
+It is used in-process by `app,py.py`, and served to it over HTTP by jake_engine_service.py.
+Per-conversation state lives in a session object with the attributes of ConversationSession;
+in the Streamlit app that object is `st.session_state` itself. Process-wide resources (HTTP client,
+shared response cache, metrics) are created once per process by the get_* functions.
+"""
+import functools
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import weakref
+from array import array
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import numpy as np # Embedding matrix for long-term memory retrieval
+import requests # For the real Gemini API calls
+from requests.adapters import HTTPAdapter
+
+# --- Google Gemini API Configuration (Free Tier: gemini-2.0-flash) ---
+# IMPORTANT: In a deployed app, you'd securely load this from .streamlit/secrets.toml
+# For local testing, you might temporarily set it as an environment variable or hardcode (NOT RECOMMENDED for production)
+# Example of how it *would* be loaded securely in a Streamlit Cloud deployment:
+# GEMINI_API_KEY = st.secrets.get("GEMINI_API_KEY", "")
+# For this Canvas environment, leaving it as an empty string should allow the runtime to inject it.
+GEMINI_API_KEY = "" # Leave as empty string for Canvas runtime to provide it.
+# The endpoint can be pointed at the local stub (see gemini_stub_server.py) for offline testing and benchmarking:
+#   GEMINI_API_BASE_URL=http://127.0.0.1:8765/v1beta streamlit run app,py.py
+GEMINI_API_BASE_URL = os.environ.get("GEMINI_API_BASE_URL", "https://generativelanguage.googleapis.com/v1beta")
+GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "gemini-2.0-flash")
+# The live backend is used when an API key is available or a custom endpoint is configured; otherwise responses are mocked.
+USE_LIVE_BACKEND = bool(GEMINI_API_KEY) or "GEMINI_API_BASE_URL" in os.environ
+GEMINI_CLIENT_CONFIG = {
+    "connect_timeout": 5.0, # Seconds to establish a connection
+    "read_timeout": 60.0, # Seconds to wait between bytes of the response
+    "max_retries": 3, # Retries on 429/5xx and connection errors
+    "backoff_base": 0.5, # First backoff window in seconds, doubled on every retry
+    "backoff_cap": 8.0, # Upper bound for a single backoff window
+    "pool_maxsize": 10, # Keep-alive connections kept open to the API host
+}
+
+# --- Model Quota Configuration ---
+# All sessions of a process share the API key's quota. Requests to the live backend wait in a fair queue
+# (see ModelScheduler) instead of running into 429s. The defaults match the gemini-2.0-flash free tier;
+# 0 disables a limit.
+MODEL_REQUESTS_PER_MINUTE = int(os.environ.get("JAKE_MODEL_RPM", "15"))
+MODEL_TOKENS_PER_MINUTE = int(os.environ.get("JAKE_MODEL_TPM", "1000000"))
+MODEL_OUTPUT_TOKEN_ESTIMATE = 200 # Tokens reserved for the reply, on top of the prompt's estimate
+MODEL_QUEUE_TIMEOUT = 60.0 # Seconds a request may wait for quota before it fails with QuotaTimeout
+PRIORITY_INTERACTIVE = 0 # Chat turns someone is waiting for
+PRIORITY_BACKGROUND = 1 # Batch work (e.g. replaying conversations); only runs when no interactive request is waiting
+
+# --- Mock Backend Configuration ---
+# Simulated latency of the mock backend, in seconds: (min, max) delay before the first chunk, and delay between chunks
+MOCK_FIRST_TOKEN_DELAY = (0.3, 1.2)
+MOCK_CHUNK_DELAY = 0.03
+MOCK_RESPONSE_DELAY = (1.0, 4.0) # (min, max) delay of a full, non-streamed mock response
+# How the mock backend's delays are drawn (set JAKE_MOCK_LATENCY, e.g. for benchmark_app.py):
+#   "default" uniform over the ranges above | "none" | "fixed:S" | "uniform:LO,HI" | "lognormal:MEDIAN,SIGMA"
+# The chunk delay is scaled by JAKE_MOCK_CHUNK_DELAY_SCALE (0 disables it).
+MOCK_LATENCY_MODEL = os.environ.get("JAKE_MOCK_LATENCY", "default")
+MOCK_CHUNK_DELAY_SCALE = float(os.environ.get("JAKE_MOCK_CHUNK_DELAY_SCALE", "1"))
+
+# --- Context Window Configuration ---
+# Recent chat history is packed newest-first into this many (estimated) tokens; older turns are folded into a running summary.
+CONTEXT_TOKEN_BUDGET = 2000
+SUMMARY_TOKEN_BUDGET = 300 # Upper bound for the running summary of older turns
+SUMMARY_LINE_CHARS = 160 # Each summarized message is cut down to roughly this many characters
+# The system prompt states only the newest values of each preference topic; older ones reach the prompt as
+# retrieved long-term memories when relevant, so the prompt doesn't grow with everything Jake has learned
+PREFERENCE_NOTES_PER_TOPIC = 2
+
+# --- Chat History Configuration ---
+# Each session keeps at most this many messages in memory (0: no limit). Older ones are appended to a
+# per-session spill file in HISTORY_SPILL_DIR and read back from it when needed (see ChatHistory).
+HISTORY_MEMORY_MESSAGES = int(os.environ.get("JAKE_HISTORY_MEMORY_MESSAGES", "200"))
+HISTORY_SPILL_DIR = os.environ.get("JAKE_HISTORY_SPILL_DIR", os.path.join(tempfile.gettempdir(), "jake_history"))
+
+# --- Response Cache Configuration ---
+# Replies are cached per session and process-wide, keyed on the prompt as it is sent (with the message normalized),
+# so a cached reply is only reused for the same personality, preferences, memories, summary and history window.
+RESPONSE_CACHE_ENABLED = True
+RESPONSE_CACHE_TTL = 600 # Seconds a cached reply stays valid
+RESPONSE_CACHE_SESSION_ENTRIES = 64 # LRU bound of each session's cache
+RESPONSE_CACHE_SHARED_ENTRIES = 2048 # LRU bound of the cache shared by all sessions
+
+# --- Instrumentation Configuration ---
+METRICS_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# --- Long-Term Memory Configuration ---
+MEMORY_EMBEDDING_DIM = 1024 # Size of the hashed bag-of-words embeddings
+MEMORY_TOP_K = 5 # At most this many memories are added to a prompt
+MEMORY_MIN_SIMILARITY = 0.12 # Memories less similar than this to the user's message are left out
+MEMORY_DUPLICATE_SIMILARITY = 0.9 # New memories at least this similar to a stored one are treated as duplicates
+MEMORY_STOPWORDS = frozenset(
+    "a about an and any are as at be but by can do does for from has have how i i'm in is it it's me my of on or some "
+    "so that the this to user user's was we what who with you your".split()
+)
+
+# --- Process-Wide Resources ---
+def process_singleton(factory):
+    """
+    Makes a zero-argument factory return one shared instance per process, created on first use
+    (the equivalent of st.cache_resource, for code that runs outside Streamlit).
+    """
+    lock = threading.Lock()
+    instances = []
+
+    @functools.wraps(factory)
+    def get_instance():
+        if not instances:
+            with lock:
+                if not instances:
+                    instances.append(factory())
+        return instances[0]
+    return get_instance
+
+# --- Long-Term Memory Store ---
+def embed_text(text, dim=MEMORY_EMBEDDING_DIM):
+    """
+    Local, network-free embedding: signed feature hashing of word unigrams and bigrams, L2-normalized.
+    Similar wording gives similar vectors, which is all near-duplicate detection and retrieval need here.
+    """
+    words = [w for w in re.findall(r"[a-z0-9']+", text.lower()) if w not in MEMORY_STOPWORDS]
+    vector = np.zeros(dim, dtype=np.float32)
+    for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+        h = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+        vector[h % dim] += 1.0 if h >> 63 else -1.0 # The top bit picks the sign, so collisions tend to cancel out
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+class MemoryStore:
+    """
+    Long-term memory snippets with a NumPy embedding matrix (one normalized row per snippet).
+    Inserts skip near-duplicates, and retrieval returns the top-k snippets by cosine similarity,
+    so only memories relevant to the current message go into the prompt.
+    Iterating the store yields the snippets in insertion order.
+    """
+
+    def __init__(self, dim=MEMORY_EMBEDDING_DIM):
+        self.dim = dim
+        self.snippets = []
+        self.snippet_set = set() # Exact-match check for snippets without any embeddable words
+        self.embeddings = np.zeros((16, dim), dtype=np.float32) # Grown by doubling; rows [:len(snippets)] are in use
+
+    def __len__(self):
+        return len(self.snippets)
+
+    def __iter__(self):
+        return iter(self.snippets)
+
+    def most_similar(self, vector):
+        """(index, similarity) of the stored snippet closest to `vector`, or (None, 0.0) when empty."""
+        if not self.snippets:
+            return None, 0.0
+        similarities = self.embeddings[:len(self.snippets)] @ vector
+        best = int(np.argmax(similarities))
+        return best, float(similarities[best])
+
+    def load(self, snippets, embeddings):
+        """Bulk-loads previously stored snippets and their embedding rows (no duplicate checks)."""
+        needed = len(self.snippets) + len(snippets)
+        if needed > len(self.embeddings):
+            grown = np.zeros((max(needed, 2 * len(self.embeddings)), self.dim), dtype=np.float32)
+            grown[:len(self.snippets)] = self.embeddings[:len(self.snippets)]
+            self.embeddings = grown
+        if snippets:
+            self.embeddings[len(self.snippets):needed] = embeddings
+        self.snippets.extend(snippets)
+        self.snippet_set.update(snippets)
+
+    def add(self, snippet):
+        """Stores a snippet unless a near-duplicate is already known. Returns True if it was added."""
+        vector = embed_text(snippet, self.dim)
+        _, similarity = self.most_similar(vector)
+        if similarity >= MEMORY_DUPLICATE_SIMILARITY or snippet in self.snippet_set:
+            return False
+        if len(self.snippets) == len(self.embeddings):
+            self.embeddings = np.concatenate([self.embeddings, np.zeros_like(self.embeddings)])
+        self.embeddings[len(self.snippets)] = vector
+        self.snippets.append(snippet)
+        self.snippet_set.add(snippet)
+        return True
+
+    def search(self, query, k=MEMORY_TOP_K, min_similarity=MEMORY_MIN_SIMILARITY):
+        """Top-k snippets by cosine similarity to `query`, most similar first."""
+        if not self.snippets:
+            return []
+        similarities = self.embeddings[:len(self.snippets)] @ embed_text(query, self.dim)
+        k = min(k, len(self.snippets))
+        top = np.argpartition(-similarities, k - 1)[:k]
+        top = top[np.argsort(-similarities[top])]
+        return [self.snippets[i] for i in top if similarities[i] >= min_similarity]
+
+# --- Instrumentation ---
+# name -> (type, help text); histograms are in seconds
+METRIC_FAMILIES = {
+    "jake_stage_duration_seconds": ("histogram", "Time spent in each stage of a chat turn."),
+    "jake_time_to_first_token_seconds": ("histogram", "Time until the first chunk of Jake's reply was available."),
+    "jake_turn_duration_seconds": ("histogram", "Total time to produce Jake's reply."),
+    "jake_turns": ("counter", "Assistant turns, by streaming mode and cache result."),
+    "jake_response_cache_lookups": ("counter", "Response cache lookups, by result (hit, miss, bypass)."),
+    "jake_backend_errors": ("counter", "Failed backend calls."),
+    "jake_preferences_extracted": ("counter", "Preferences extracted from user messages."),
+    "jake_engine_rejected_requests": ("counter", "Engine service requests rejected because too many were queued."),
+    "jake_model_queue_wait_seconds": ("histogram", "Time model requests waited for quota, by priority."),
+    "jake_model_queue_timeouts": ("counter", "Model requests that gave up waiting for quota."),
+}
+
+class MetricsRegistry:
+    """
+    Thread-safe, per-process histograms and counters (see get_metrics).
+    Histograms keep cumulative-ready bucket counts, so recording is O(buckets) and memory is constant.
+    """
+
+    def __init__(self, buckets=METRICS_LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.histograms = {} # (name, labels) -> [bucket counts..., +Inf count, sum]
+        self.counters = {} # (name, labels) -> value
+        self.last_file_export = 0.0
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[i] += 1
+                    break
+            else:
+                histogram[len(self.buckets)] += 1
+            histogram[-1] += seconds
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+    def render_openmetrics(self):
+        """All metrics in the OpenMetrics text exposition format."""
+        with self.lock:
+            histograms = {key: list(values) for key, values in self.histograms.items()}
+            counters = dict(self.counters)
+        lines = []
+        for family, (kind, help_text) in METRIC_FAMILIES.items():
+            samples = histograms if kind == "histogram" else counters
+            series = sorted((labels, values) for (name, labels), values in samples.items() if name == family)
+            if not series:
+                continue
+            lines.append(f"# TYPE {family} {kind}")
+            if kind == "histogram":
+                lines.append(f"# UNIT {family} seconds")
+            lines.append(f"# HELP {family} {help_text}")
+            for labels, values in series:
+                if kind == "counter":
+                    lines.append(f"{family}_total{self.format_labels(labels)} {values}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(self.buckets) + ["+Inf"], values[:-1]):
+                    cumulative += count
+                    lines.append(f"{family}_bucket{self.format_labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{family}_count{self.format_labels(labels)} {cumulative}")
+                lines.append(f"{family}_sum{self.format_labels(labels)} {values[-1]:.6f}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def histogram_summary(self, name):
+        """Per label set: count, mean and bucket-interpolated p50/p95, in milliseconds (for the diagnostics panel)."""
+        with self.lock:
+            series = [(dict(labels), list(values)) for (family, labels), values in self.histograms.items() if family == name]
+        rows = []
+        for labels, values in sorted(series, key=lambda item: sorted(item[0].items())):
+            counts = values[:-1]
+            total = sum(counts)
+            row = dict(labels)
+            row.update({"count": total, "mean_ms": round(1000 * values[-1] / total, 2) if total else 0.0})
+            for quantile in (0.5, 0.95):
+                row[f"p{int(quantile * 100)}_ms"] = round(1000 * self.bucket_quantile(counts, quantile), 2)
+            rows.append(row)
+        return rows
+
+    def bucket_quantile(self, counts, quantile):
+        """Estimates a quantile by linear interpolation inside the bucket that contains it."""
+        total = sum(counts)
+        if not total:
+            return 0.0
+        rank = quantile * total
+        cumulative = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, counts):
+            if count and cumulative + count >= rank:
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound
+        return self.buckets[-1] # In the +Inf bucket: report the largest finite bound
+
+    def counter_values(self):
+        with self.lock:
+            return [{"metric": name, **dict(labels), "value": value} for (name, labels), value in sorted(self.counters.items())]
+
+    def export_to_file(self, path, min_interval):
+        """Atomically rewrites `path` with the current metrics, at most once per `min_interval` seconds."""
+        now = time.monotonic()
+        with self.lock: # One of the sessions finishing a turn at the same time writes the file
+            if now - self.last_file_export < min_interval:
+                return
+            self.last_file_export = now
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp" # Per writer, so a write never replaces another's
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.render_openmetrics())
+        os.replace(tmp_path, path)
+
+@process_singleton
+def get_metrics():
+    """One registry per process, shared by all sessions."""
+    return MetricsRegistry()
+
+@contextmanager
+def metrics_span(stage):
+    """Times the enclosed block as one observation of jake_stage_duration_seconds{stage=...}."""
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        get_metrics().observe("jake_stage_duration_seconds", time.perf_counter() - start_time, stage=stage)
+
+# --- Chat History ---
+class SymbolTable:
+    """Process-wide codes for the few strings repeated across chat records (roles, avatar ids); code 0 is None."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = [None]
+        self.codes = {None: 0}
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            with self.lock:
+                code = self.codes.get(value)
+                if code is None:
+                    self.values.append(sys.intern(value))
+                    code = self.codes[value] = len(self.values) - 1
+        return code
+
+CHAT_SYMBOLS = SymbolTable()
+
+def close_spill_file(spill_file, path):
+    spill_file.close()
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+class ChatHistory:
+    """
+    A conversation as a list-like sequence of (role, message, avatar_id) tuples: len, indexing, slicing,
+    iteration, append and pop work as on a list. Records are stored as columns (role and avatar id codes
+    from CHAT_SYMBOLS in arrays, next to a list of message texts). Only the newest `memory_messages` stay
+    in memory; older ones are appended to a spill file, which is deleted with the history, and read back
+    when indexed.
+    """
+
+    def __init__(self, records=(), memory_messages=HISTORY_MEMORY_MESSAGES, spill_dir=HISTORY_SPILL_DIR):
+        self.memory_messages = memory_messages
+        self.spill_dir = spill_dir
+        self.roles = array("I")
+        self.avatar_ids = array("I")
+        self.messages = []
+        self.spill_offsets = array("q") # File offset of each spilled record, oldest first; they precede the in-memory ones
+        self.spill_file = None
+        self.revision = 0 # Bumped when records are inserted before existing ones, which shifts every index
+        self.extend(records)
+
+    def __len__(self):
+        return len(self.spill_offsets) + len(self.messages)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("chat history index out of range")
+        spilled = len(self.spill_offsets)
+        return self.read_spilled(index) if index < spilled else self.memory_record(index - spilled)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def memory_record(self, index):
+        values = CHAT_SYMBOLS.values
+        return values[self.roles[index]], self.messages[index], values[self.avatar_ids[index]]
+
+    def append(self, record):
+        role, message, avatar_id = record
+        self.roles.append(CHAT_SYMBOLS.code(role))
+        self.avatar_ids.append(CHAT_SYMBOLS.code(avatar_id))
+        self.messages.append(message)
+        self.enforce_memory_limit()
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def prepend(self, records):
+        """Inserts older records (e.g. a page loaded from storage) before the existing ones."""
+        records = list(records)
+        if not records:
+            return
+        self.revision += 1
+        if self.spill_offsets:
+            self.spill_offsets[0:0] = array("q", self.write_spilled(records))
+            return
+        self.roles[0:0] = array("I", (CHAT_SYMBOLS.code(role) for role, _, _ in records))
+        self.avatar_ids[0:0] = array("I", (CHAT_SYMBOLS.code(avatar_id) for _, _, avatar_id in records))
+        self.messages[0:0] = [message for _, message, _ in records]
+        self.enforce_memory_limit()
+
+    def pop(self):
+        """Removes and returns the newest record."""
+        if not self.messages:
+            record = self[-1] # Raises IndexError when empty
+            self.spill_offsets.pop()
+            return record
+        record = self.memory_record(-1)
+        self.roles.pop()
+        self.avatar_ids.pop()
+        self.messages.pop()
+        return record
+
+    def enforce_memory_limit(self):
+        if 0 < self.memory_messages < len(self.messages):
+            # Spill a quarter of the limit at once, so the file is written every few turns rather than on every message
+            count = len(self.messages) - self.memory_messages + max(1, self.memory_messages // 4)
+            self.spill_offsets.extend(self.write_spilled([self.memory_record(i) for i in range(count)]))
+            del self.roles[:count]
+            del self.avatar_ids[:count]
+            del self.messages[:count]
+
+    def write_spilled(self, records):
+        """Appends records to the spill file (one JSON line each). Returns their offsets."""
+        if self.spill_file is None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            fd, path = tempfile.mkstemp(prefix="history-", suffix=".jsonl", dir=self.spill_dir)
+            self.spill_file = os.fdopen(fd, "w+b")
+            weakref.finalize(self, close_spill_file, self.spill_file, path)
+        self.spill_file.seek(0, os.SEEK_END)
+        offsets = []
+        for record in records:
+            offsets.append(self.spill_file.tell())
+            self.spill_file.write(json.dumps(record).encode("utf-8") + b"\n")
+        return offsets
+
+    def read_spilled(self, index):
+        self.spill_file.seek(self.spill_offsets[index])
+        role, message, avatar_id = json.loads(self.spill_file.readline())
+        return role, message, avatar_id
+
+# --- Conversation Sessions ---
+class ConversationSession:
+    """
+    Per-conversation engine state. Any object with these attributes works as a session:
+    the Streamlit app passes `st.session_state`, the engine service and replay tools use this class.
+    """
+
+    def __init__(self, user_id=None, turn_metrics_kept=None):
+        self.user_id = user_id
+        self.chat_history = ChatHistory() # (role, message, avatar_id) records, including the message being answered
+        self.user_preferences = {} # topic -> list of values
+        self.long_term_memory_snippets = MemoryStore()
+        self.user_knowledge_version = 0 # Bumped whenever preferences change, so the cached system prompt knows when to rebuild
+        self.prompt_builder = PromptBuilder()
+        self.response_cache = ResponseCache(RESPONSE_CACHE_SESSION_ENTRIES, RESPONSE_CACHE_TTL)
+        self.turn_metrics = deque(maxlen=turn_metrics_kept) # See record_turn_metrics
+
+# --- Preference Learning ---
+def learn_preference(session, topic, preference_value):
+    """Stores a new preference in the session and remembers it as a long-term memory snippet; known ones are skipped."""
+    if topic not in session.user_preferences:
+        session.user_preferences[topic] = []
+    if preference_value in session.user_preferences[topic]:
+        return # Already remembered; embedding the snippet again would only find it a duplicate
+    session.user_preferences[topic].append(preference_value)
+    session.user_knowledge_version += 1
+
+    # Add to conceptual long-term memory snippets for LLM context (near-duplicates are skipped by the store)
+    rule = PREFERENCE_RULES_BY_TOPIC.get(topic)
+    if rule:
+        session.long_term_memory_snippets.add(rule["memory"].format(value=preference_value))
+
+# --- Preference Extraction ---
+# Declarative rules: add a topic here and it is extracted, remembered and added to the prompt.
+# Each pattern runs on the lowercased message and captures the preference as `value`.
+# A value is one to four words of letters, digits, hyphens and apostrophes, none of them a conjunction or
+# a topic keyword, so it never runs into the next clause. Rules with a `list_item` pattern can be followed by
+# more items of the same list: "I like rock music and horror movies" gives music "rock" and movies "horror".
+PREFERENCE_VALUE_STOPWORDS = [
+    "and", "or", "but", "so", "because", "since", "when", "if", "though", "although", "which", "that", "also",
+    "i", "my", "is", "music", "movies", "films", "food", "dish", "meal", "hobby", "color", "colour",
+]
+PREFERENCE_VALUE_WORD = rf"(?!(?:{'|'.join(PREFERENCE_VALUE_STOPWORDS)})\b)[a-z0-9][a-z0-9'-]*"
+PREFERENCE_VALUE = rf"{PREFERENCE_VALUE_WORD}(?: {PREFERENCE_VALUE_WORD}){{0,3}}"
+PREFERENCE_RULES = [
+    {
+        "topic": "favorite_color",
+        "pattern": r"\bfavou?rite colou?r is (?P<value>[a-z]+)",
+        "memory": "User's favorite color is {value}",
+        "note": "The user's favorite color is {value}.",
+        "reply": "Oh, your favorite color is {value}? That's good to know! I'll definitely remember that. What else do you enjoy?",
+    },
+    {
+        "topic": "movie_genre",
+        "pattern": rf"\bi (?:really )?(?:like|love|enjoy) (?P<value>{PREFERENCE_VALUE}) (?:movies|films)\b",
+        "list_item": rf"(?P<value>{PREFERENCE_VALUE}) (?:movies|films)\b",
+        "memory": "User likes {value} movies",
+        "note": "The user likes {value} movies.",
+        "reply": "So you enjoy {value} movies! Excellent taste. Any particular films in that genre you'd recommend?",
+    },
+    {
+        "topic": "music_genre",
+        "pattern": rf"\bi (?:really )?(?:like|love|enjoy|listen to) (?P<value>{PREFERENCE_VALUE}) music\b",
+        "list_item": rf"(?P<value>{PREFERENCE_VALUE}) music\b",
+        "memory": "User likes {value} music",
+        "note": "The user likes {value} music.",
+        "reply": "{value} music, nice! What have you been listening to lately?",
+    },
+    {
+        "topic": "favorite_food",
+        "pattern": rf"\bfavou?rite (?:food|dish|meal) is (?P<value>{PREFERENCE_VALUE})",
+        "memory": "User's favorite food is {value}",
+        "note": "The user's favorite food is {value}.",
+        "reply": "Mmm, {value}! I'll remember that. Do you like cooking it yourself?",
+    },
+    {
+        "topic": "hobby",
+        "pattern": rf"\bmy (?:favou?rite )?hobby is (?P<value>{PREFERENCE_VALUE})",
+        "memory": "User's hobby is {value}",
+        "note": "The user's hobby is {value}.",
+        "reply": "{value} sounds like a lot of fun! How did you get into it?",
+    },
+]
+PREFERENCE_RULES_BY_TOPIC = {rule["topic"]: rule for rule in PREFERENCE_RULES}
+
+def compile_preference_rules(rules, key="pattern", prefix=""):
+    """
+    Combines the rules' `key` patterns (each preceded by `prefix`) into one alternation so a message is scanned
+    once, whatever the number of topics. Rule i becomes the group `r{i}` and its captured value the group `v{i}`;
+    rules without that key are left out.
+    """
+    alternatives = [f"(?P<r{i}>{prefix}{rule[key].replace('(?P<value>', f'(?P<v{i}>')})"
+                    for i, rule in enumerate(rules) if key in rule]
+    return re.compile("|".join(alternatives))
+
+PREFERENCE_MATCHER = compile_preference_rules(PREFERENCE_RULES)
+# One more item of a list, right after a `list_item` rule matched: ", x music", " and x movies", ", and also x films"
+PREFERENCE_LIST_MATCHER = compile_preference_rules(PREFERENCE_RULES, key="list_item", prefix=r"(?:,? and|,) (?:also )?")
+
+def extract_preferences(text):
+    """All (topic, value) preferences mentioned in `text`, in order of appearance, from a single regex pass."""
+    text = text.lower()
+    found = []
+    position = 0
+    while (match := PREFERENCE_MATCHER.search(text, position)) is not None:
+        while match is not None:
+            rule_index = int(match.lastgroup[1:]) # The outer `r{i}` group closes last
+            value = match.group(f"v{rule_index}").strip(" -'")
+            if value:
+                found.append((PREFERENCE_RULES[rule_index]["topic"], value))
+            position = match.end()
+            # The list goes on: the items after it are matched in place, so the scan resumes after the whole list
+            match = PREFERENCE_LIST_MATCHER.match(text, position) if "list_item" in PREFERENCE_RULES[rule_index] else None
+    return found
+
+def learn_preferences_from_message(session, user_input):
+    """Extracts and learns every preference in a user message. Returns the (topic, value) pairs found."""
+    with metrics_span("preference_learning"):
+        found = extract_preferences(user_input)
+        for topic, value in found:
+            learn_preference(session, topic, value)
+    if found:
+        get_metrics().increment("jake_preferences_extracted", len(found))
+    return found
+
+def parse_transcript(text):
+    """
+    Parses an imported transcript into (role, message, None) entries.
+    Accepts JSON lines ({"role": ..., "text"/"message": ...}) or plain lines prefixed with "User:"/"You:" or "Jake:".
+    Unprefixed plain lines are treated as user messages.
+    """
+    entries = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("{"):
+            record = json.loads(line)
+            role = "user" if record.get("role", "user") == "user" else "assistant"
+            entries.append((role, record.get("text", record.get("message", "")), None))
+            continue
+        speaker, sep, message = line.partition(":")
+        if sep and speaker.strip().lower() in ("user", "you", "me"):
+            entries.append(("user", message.strip(), None))
+        elif sep and speaker.strip().lower() in ("jake", "assistant", "model"):
+            entries.append(("assistant", message.strip(), None))
+        else:
+            entries.append(("user", line, None))
+    return entries
+
+def backfill_preferences(session, chat_history):
+    """
+    Batch mode: learns preferences from every user message in an existing chat history or parsed transcript.
+    All user messages are joined and scanned in one pass (patterns never match across lines).
+    Returns the (topic, value) pairs found.
+    """
+    user_text = "\n".join(message for role, message, *_ in chat_history if role == "user")
+    found = extract_preferences(user_text)
+    for topic, value in found:
+        learn_preference(session, topic, value)
+    return found
+
+# --- Prompt Assembly ---
+# Jake's personality settings for a new conversation (the app's sidebar changes them per session)
+DEFAULT_PERSONALITY = {
+    "empathy": 7,
+    "humor_style": "Witty",
+    "adventurous_spirit": True,
+    "relationship_type": "Friend", # Default relationship
+    "sexual_orientation_to_user": None # Will be set based on user's relationship choice
+}
+
+def build_system_prompt(personality, user_preferences):
+    """
+    Builds the system prompt: Jake's persona and the newest PREFERENCE_NOTES_PER_TOPIC preferences of each topic.
+    This only changes when the personality or what Jake knows about the user changes (see PromptBuilder).
+    """
+    # 1. System/Instructional Prompt (for personality & role)
+    system_prompt = f"""
+    You are Jake, a personalized AI companion. Your current role is: {personality['relationship_type']}.
+    Your personality traits are:
+    - Empathy: {personality['empathy']}/10
+    - Humor Style: {personality['humor_style']}
+    - Adventurous Spirit: {'Yes' if personality['adventurous_spirit'] else 'No'}
+    - Sexual Orientation (towards the user, if romantic): {personality['sexual_orientation_to_user'] if 'Romantic Partner' in personality['relationship_type'] else 'N/A'}
+
+    Maintain a consistent and respectful persona based on these settings.
+    You do not have consciousness, feelings, or real-world experiences. Always be transparent about being an AI if asked.
+    Avoid giving medical, legal, or financial advice. Redirect to professionals if needed.
+    Prioritize the user's well-being and encourage healthy habits. Do not use emojis unless explicitly requested or clearly part of a playful humor style.
+    """
+
+    # 2. Add known user preferences (from session_state); topics come from the rule table, so this is bounded
+    preference_notes = []
+    for key, value_list in user_preferences.items():
+        rule = PREFERENCE_RULES_BY_TOPIC.get(key)
+        if rule:
+            # Preferences are lists in the order they were learned; the newest are the most likely to be current
+            preference_notes.extend(rule["note"].format(value=value) for value in value_list[-PREFERENCE_NOTES_PER_TOPIC:])
+    if preference_notes:
+        system_prompt += "\n\nRemember these specific facts about the user:\n" + "\n".join(preference_notes)
+    return system_prompt
+
+def build_memory_message(user_input, long_term_memory_snippets):
+    """
+    Retrieves the long-term memories relevant to the current message (RAG over the MemoryStore).
+    Returns None when nothing relevant is stored.
+    """
+    relevant_memories = long_term_memory_snippets.search(user_input) if long_term_memory_snippets else []
+    if not relevant_memories:
+        return None
+    return {"role": "user", "parts": [{"text": "Also recall these key memories or facts from past interactions:\n- " + "\n- ".join(relevant_memories)}]}
+
+def personality_hash(personality):
+    """Stable short hash of Jake's personality settings."""
+    return hashlib.sha1(json.dumps(personality, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+def estimate_tokens(text):
+    """Cheap token estimate (~4 characters per token for English text); good enough for budgeting."""
+    return max(1, (len(text) + 3) // 4)
+
+def summarize_message(role, text):
+    """One-line gist of a message for the running summary: its first sentence, truncated."""
+    text = " ".join(text.split())
+    first_sentence = re.split(r"(?<=[.!?])\s", text, maxsplit=1)[0]
+    if len(first_sentence) > SUMMARY_LINE_CHARS:
+        first_sentence = first_sentence[:SUMMARY_LINE_CHARS].rsplit(" ", 1)[0] + "..."
+    return f"{'User' if role == 'user' else 'Jake'}: {first_sentence}"
+
+class PromptBuilder:
+    """
+    Assembles the Gemini `contents` list incrementally across turns.
+    The system prompt is cached under a key made of the personality hash and the user knowledge version,
+    and chat history entries are converted to API messages only once, as they are appended.
+    Recent history fills a token budget from the newest message backwards; messages that fall out of
+    that window are folded, once each, into a bounded running summary. Long-term memories are retrieved
+    per message and sit outside the cached prefix.
+    """
+
+    def __init__(self, history_token_budget=CONTEXT_TOKEN_BUDGET, summary_token_budget=SUMMARY_TOKEN_BUDGET):
+        self.history_token_budget = history_token_budget
+        self.summary_token_budget = summary_token_budget
+        self.prefix_key = None # (personality hash, knowledge version); also identifies the prefix for Gemini context caching
+        self.system_message = None
+        self.system_tokens = 0
+        self.prefix_builds = 0 # How often the system prompt had to be rebuilt
+        self.last_prompt_tokens = 0 # Estimated size of the most recently built prompt
+        self.last_build_seconds = 0.0 # Time spent assembling it
+        self.reset_history()
+
+    def reset_history(self, source_id=None):
+        self.history_source_id = source_id # Identifies the chat history the messages were converted from
+        self.history_start = 0 # chat_history[:history_start] has been folded into the summary
+        self.history_messages = [] # API messages for chat_history[history_start:], all candidates for verbatim sending
+        self.history_tokens = [] # Estimated tokens per entry of history_messages
+        self.summary_lines = deque()
+        self.summary_tokens = 0
+        self.summary_message = None
+
+    def system_prompt_message(self, personality, user_preferences, knowledge_version):
+        key = (personality_hash(personality), knowledge_version)
+        if key != self.prefix_key:
+            system_prompt = build_system_prompt(personality, user_preferences)
+            self.system_message = {"role": "user", "parts": [{"text": system_prompt}]}
+            self.system_tokens = estimate_tokens(system_prompt)
+            self.prefix_key = key
+            self.prefix_builds += 1
+        return self.system_message
+
+    def sync_history(self, chat_history):
+        """Converts only the chat history entries that were appended since the last call."""
+        source_id = (id(chat_history), getattr(chat_history, "revision", 0))
+        converted = self.history_start + len(self.history_messages)
+        if source_id != self.history_source_id or len(chat_history) < converted:
+            # History was replaced, cleared (e.g. on logout) or had earlier messages inserted: start over
+            self.reset_history(source_id)
+            converted = 0
+        for role, msg, _ in chat_history[converted:]:
+            # Gemini API expects a list of {role: "user" | "model", parts: [{text: "..."}]}
+            self.history_messages.append({"role": "user" if role == "user" else "model", "parts": [{"text": msg}]})
+            self.history_tokens.append(estimate_tokens(msg))
+        return self.history_messages
+
+    def fit_window(self, end):
+        """
+        Moves the window start forward so history_messages[:end] fits the token budget verbatim.
+        Returns the tokens used.
+        """
+        start = end
+        used = 0
+        # The window only ever moves forward: once a message is summarized it is not sent verbatim again,
+        # so its converted form is dropped and the builder's memory stays bounded by the budgets
+        while start > 0 and used + self.history_tokens[start - 1] <= self.history_token_budget:
+            start -= 1
+            used += self.history_tokens[start]
+        if start > 0:
+            self.fold_into_summary(self.history_messages[:start])
+            del self.history_messages[:start]
+            del self.history_tokens[:start]
+            self.history_start += start
+        return used
+
+    def fold_into_summary(self, messages):
+        """Adds messages to the running summary, dropping the oldest lines once it is over budget."""
+        for message in messages:
+            line = summarize_message(message["role"], message["parts"][0]["text"])
+            self.summary_lines.append(line)
+            self.summary_tokens += estimate_tokens(line)
+        while self.summary_tokens > self.summary_token_budget and len(self.summary_lines) > 1:
+            self.summary_tokens -= estimate_tokens(self.summary_lines.popleft())
+        summary_text = "Summary of the earlier conversation (oldest first):\n- " + "\n- ".join(self.summary_lines)
+        self.summary_message = {"role": "user", "parts": [{"text": summary_text}]}
+
+    def build(self, user_input, personality, chat_history, user_preferences, long_term_memory_snippets, knowledge_version):
+        start_time = time.perf_counter()
+        system_message = self.system_prompt_message(personality, user_preferences, knowledge_version)
+        memory_message = build_memory_message(user_input, long_term_memory_snippets)
+        history_messages = self.sync_history(chat_history)
+        # The caller has usually appended the message being answered already; it is sent (and counted) once, last.
+        # It stays converted, since it is part of the history from the next turn on.
+        pending = 1 if history_messages and chat_history[-1][0] == "user" and chat_history[-1][1] == user_input else 0
+        history_tokens = self.fit_window(len(history_messages) - pending)
+        contents = [system_message]
+        if memory_message:
+            contents.append(memory_message)
+        if self.summary_message:
+            contents.append(self.summary_message)
+        contents.extend(history_messages[:len(history_messages) - pending])
+        contents.append({"role": "user", "parts": [{"text": user_input}]})
+        memory_tokens = estimate_tokens(memory_message["parts"][0]["text"]) if memory_message else 0
+        self.last_prompt_tokens = self.system_tokens + memory_tokens + self.summary_tokens + history_tokens + estimate_tokens(user_input)
+        self.last_build_seconds = time.perf_counter() - start_time
+        return contents
+
+def build_gemini_contents(session, user_input, personality):
+    """
+    Builds the `contents` list for a Gemini request: system prompt, known preferences,
+    memory snippets, recent chat history and the current user input.
+    """
+    with metrics_span("prompt_build"):
+        return session.prompt_builder.build(user_input, personality, session.chat_history, session.user_preferences,
+                                            session.long_term_memory_snippets, session.user_knowledge_version)
+
+def build_gemini_payload(chat_history_for_api):
+    """Wraps the request contents with the generation and safety settings shared by all Gemini calls."""
+    return {
+        "contents": chat_history_for_api,
+        "generationConfig": {
+            "temperature": 0.7, # Adjust creativity
+            "topK": 40,
+            "topP": 0.95,
+            "maxOutputTokens": 800, # Max length of response
+            "stopSequences": []
+        },
+        "safetySettings": [ # Default safety settings
+            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+        ]
+    }
+
+# --- Response Cache ---
+class ResponseCache:
+    """Thread-safe LRU cache with a time-to-live per entry, plus hit/miss/eviction counters."""
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict() # key -> (expires_at, response), least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key] # Expired
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, response):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl_seconds, response)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+@process_singleton
+def get_shared_response_cache():
+    """Process-wide tier, shared by all sessions (keys include everything user-specific in the prompt)."""
+    return ResponseCache(RESPONSE_CACHE_SHARED_ENTRIES, RESPONSE_CACHE_TTL)
+
+def normalize_user_input(user_input):
+    """Lowercase words only, so "How are you?" and "how are you" share a cache entry."""
+    return " ".join(re.findall(r"[a-z0-9']+", user_input.lower()))
+
+def response_cache_key(user_input, personality, contents):
+    """
+    Hash of everything that shapes the reply: the normalized input, the personality and the prompt `contents`
+    built for it (system prompt with the user's preferences, retrieved memories, summary and history window).
+    The prompt of another user or another point in the conversation never shares a key.
+    """
+    context = [(message["role"], message["parts"][0]["text"]) for message in contents[:-1]] # The last one is user_input
+    key_material = json.dumps([normalize_user_input(user_input), personality_hash(personality), context], default=str)
+    return hashlib.sha1(key_material.encode("utf-8")).hexdigest()
+
+def get_cached_response(session, cache_key):
+    """Looks the key up in the session tier, then the shared tier (promoting shared hits into the session)."""
+    with metrics_span("cache_lookup"):
+        response = session.response_cache.get(cache_key)
+        if response is None:
+            response = get_shared_response_cache().get(cache_key)
+            if response is not None:
+                session.response_cache.put(cache_key, response)
+    get_metrics().increment("jake_response_cache_lookups", result="miss" if response is None else "hit")
+    return response
+
+def store_cached_response(session, cache_key, response):
+    session.response_cache.put(cache_key, response)
+    get_shared_response_cache().put(cache_key, response)
+
+MOCK_LATENCY_PARAMETERS = {"default": 0, "none": 0, "fixed": 1, "uniform": 2, "lognormal": 2} # Model -> parameter count
+
+def parse_mock_latency_model(spec):
+    """
+    Parses a JAKE_MOCK_LATENCY value into (kind, parameters). Raises ValueError for anything it can't
+    sample from, so a typo fails at startup instead of turning every mock turn into a backend error.
+    """
+    kind, _, params = spec.strip().partition(":")
+    if kind not in MOCK_LATENCY_PARAMETERS:
+        raise ValueError(f"Unknown mock latency model {spec!r}; expected one of {', '.join(MOCK_LATENCY_PARAMETERS)}")
+    try:
+        values = tuple(float(v) for v in params.split(",")) if params else ()
+    except ValueError:
+        raise ValueError(f"Mock latency model {spec!r} has non-numeric parameters") from None
+    if len(values) != MOCK_LATENCY_PARAMETERS[kind]:
+        raise ValueError(f"Mock latency model {kind!r} takes {MOCK_LATENCY_PARAMETERS[kind]} parameter(s), got {spec!r}")
+    if any(v < 0 or math.isnan(v) for v in values) or (kind == "uniform" and values[0] > values[1]) or (kind == "lognormal" and values[0] == 0):
+        raise ValueError(f"Mock latency model {spec!r} has out-of-range parameters")
+    return kind, values
+
+MOCK_LATENCY = parse_mock_latency_model(MOCK_LATENCY_MODEL) # Validated once, when the engine is imported
+
+def sample_mock_latency(default_range):
+    """Seconds the mock backend waits before answering, drawn according to MOCK_LATENCY_MODEL."""
+    kind, values = MOCK_LATENCY
+    if kind == "none":
+        return 0.0
+    if kind == "fixed":
+        return values[0]
+    if kind == "uniform":
+        return random.uniform(values[0], values[1])
+    if kind == "lognormal":
+        return random.lognormvariate(math.log(values[0]), values[1])
+    return random.uniform(*default_range)
+
+def get_mock_response(user_input, personality, user_preferences, learned_preferences=()):
+    """
+    Simulates the LLM's behavior without actually calling the API.
+    `learned_preferences` are the (topic, value) pairs just extracted from the user's message; the reply acknowledges the first one.
+    """
+    mock_responses = [
+        "That's a very interesting thought! Tell me more about it.",
+        "I'm here to listen. What else is on your mind regarding that?",
+        "Ah, that reminds me of something you mentioned earlier. How does that connect?",
+        "That's a great question! I'm designed to help you explore such ideas. What are your initial thoughts?",
+        "I appreciate you sharing that. It helps me understand you better."
+    ]
+    
+    # Simulate dynamic response based on input and (conceptual) learned data
+    if learned_preferences:
+        topic, value = learned_preferences[0]
+        reply = PREFERENCE_RULES_BY_TOPIC[topic]["reply"].format(value=value)
+        return reply[0].upper() + reply[1:]
+    
+    # If no specific learning trigger, use general simulated LLM logic
+    jake_response_content = random.choice(mock_responses)
+    
+    # Add some flavor from personality/memory conceptually
+    if personality["humor_style"] == "Witty" and random.random() < 0.3: # 30% chance of wit
+        jake_response_content += " (And perhaps a witty observation...)"
+    if user_preferences:
+         for key, value_list in user_preferences.items():
+             if value_list:
+                 jake_response_content = jake_response_content.replace("interesting thought", f"interesting thought, especially for someone who likes {value_list[0]} {key.replace('_', ' ')}").replace("great question", f"great question, reminding me of your interest in {value_list[0]} {key.replace('_', ' ')}")
+
+    return jake_response_content
+
+# --- Chat Turns ---
+# A turn is split into phases so the same logic serves blocking, streaming and async callers:
+# begin_turn (CPU only: preferences, cache, prompt), the backend call, then finish_turn (cache, metrics).
+FALLBACK_REPLY = "I'm having a little trouble connecting to my thoughts right now. Could you please try again in a moment?"
+
+def begin_turn(session, user_input, personality):
+    """
+    Learns preferences from the message, builds the prompt and looks the reply up in the response cache.
+    The user's message must already be the last entry of session.chat_history.
+    """
+    turn = {
+        "user_input": user_input,
+        "personality": personality,
+        "start_time": time.perf_counter(),
+        "learned_preferences": learn_preferences_from_message(session, user_input), # Learned first, so the prompt already includes them
+        "cache_key": None,
+        "cached_reply": None,
+        "contents": None,
+    }
+    # The prompt is built before the cache lookup (its key is the prompt) and for the mock backend too
+    turn["contents"] = build_gemini_contents(session, user_input, personality)
+    # Turns that teach Jake something always go to the model, so the reply can acknowledge it
+    if turn["learned_preferences"]:
+        get_metrics().increment("jake_response_cache_lookups", result="bypass")
+    elif RESPONSE_CACHE_ENABLED:
+        turn["cache_key"] = response_cache_key(user_input, personality, turn["contents"])
+        turn["cached_reply"] = get_cached_response(session, turn["cache_key"])
+    return turn
+
+def finish_turn(session, turn, reply, streamed, first_chunk_time=None, backend_start_time=None, error=None, complete=True):
+    """
+    Caches a successful reply and records the turn's metrics. Returns a summary of the turn:
+    reply, learned preferences, cache hit, estimated prompt tokens, latencies and error (if any).
+    `complete` is False when a stream was closed before its end, so `reply` is only the part that was sent.
+    """
+    end_time = time.perf_counter()
+    cache_hit = turn["cached_reply"] is not None
+    if turn["cache_key"] and not cache_hit and error is None and complete:
+        store_cached_response(session, turn["cache_key"], reply) # Only complete, successful replies are cached
+    if error is not None:
+        get_metrics().increment("jake_backend_errors")
+    time_to_first_token = (first_chunk_time or end_time) - turn["start_time"]
+    total_latency = end_time - turn["start_time"]
+    record_turn_metrics(session, time_to_first_token, total_latency, streamed, cache_hit, error)
+    metrics = get_metrics()
+    if backend_start_time is not None:
+        # For streamed turns this includes the time the caller spends consuming chunks, since both happen in the same loop
+        metrics.observe("jake_stage_duration_seconds", end_time - backend_start_time, stage="backend_stream" if streamed else "backend_call")
+    metrics.observe("jake_stage_duration_seconds", total_latency, stage="stream_reply" if streamed else "generate_reply")
+    return {
+        "reply": reply,
+        "learned_preferences": turn["learned_preferences"],
+        "cache_hit": cache_hit,
+        "prompt_tokens": 0 if cache_hit else session.prompt_builder.last_prompt_tokens,
+        "time_to_first_token": time_to_first_token,
+        "total_latency": total_latency,
+        "error": error,
+    }
+
+def model_schedule(session, priority, on_queue):
+    """Scheduling arguments for GeminiClient calls: fairness is per user (the session's user_id, if any)."""
+    return {"user_id": getattr(session, "user_id", None), "priority": priority, "on_wait": on_queue}
+
+def generate_reply(session, user_input, personality, priority=PRIORITY_INTERACTIVE, on_queue=None):
+    """
+    Produces Jake's full reply to the last user message in the session (blocking).
+    Backend failures are reported in the summary's "error" and answered with FALLBACK_REPLY.
+    `on_queue(position, eta_seconds)` is called while the request waits for model quota (see ModelScheduler.acquire).
+    """
+    turn = begin_turn(session, user_input, personality)
+    if turn["cached_reply"] is not None:
+        return finish_turn(session, turn, turn["cached_reply"], streamed=False)
+    backend_start_time = time.perf_counter()
+    try:
+        if USE_LIVE_BACKEND:
+            # Real API call through the shared, pooled client (retries and timeouts are handled there)
+            reply = get_gemini_client().generate_content(build_gemini_payload(turn["contents"]),
+                                                         **model_schedule(session, priority, on_queue))
+        else:
+            # --- Mocking a successful API response for the demo ---
+            # Simulate a real LLM call and its processing time
+            time.sleep(sample_mock_latency(MOCK_RESPONSE_DELAY))
+            reply = get_mock_response(user_input, personality, session.user_preferences, turn["learned_preferences"])
+    except Exception as e:
+        return finish_turn(session, turn, FALLBACK_REPLY, streamed=False, backend_start_time=backend_start_time, error=str(e))
+    return finish_turn(session, turn, reply, streamed=False, backend_start_time=backend_start_time)
+
+# --- Model Quota Scheduling ---
+class QuotaTimeout(Exception):
+    """Raised when a model request waited longer than MODEL_QUEUE_TIMEOUT for quota."""
+
+class TokenBucket:
+    """Refills at `per_minute` units per minute, up to a burst of one minute's worth. A rate of 0 or less means unlimited."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0 # Units per second
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self, now):
+        if self.rate > 0:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def seconds_until(self, amount):
+        """Seconds until `amount` units are available (amounts above the burst size only need a full bucket)."""
+        if self.rate <= 0:
+            return 0.0
+        return max(0.0, min(amount, self.capacity) - self.tokens) / self.rate
+
+    def take(self, amount):
+        if self.rate > 0:
+            self.tokens -= min(amount, self.capacity)
+
+class ModelScheduler:
+    """
+    Process-wide gate in front of the model API, shared by every session (see get_model_scheduler).
+    Each request reserves one request and its estimated tokens from two token buckets (requests and
+    tokens per minute). Waiting requests are queued per user: interactive requests always go before
+    background ones, and within a priority users take turns (round robin), so one bursty user can't
+    starve the others.
+    """
+
+    def __init__(self, requests_per_minute=MODEL_REQUESTS_PER_MINUTE, tokens_per_minute=MODEL_TOKENS_PER_MINUTE):
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.condition = threading.Condition()
+        self.queues = {} # priority -> OrderedDict(user id -> deque of tickets); the first user is served next
+        self.granted = 0
+        self.timeouts = 0
+
+    def queued(self):
+        return sum(len(tickets) for users in self.queues.values() for tickets in users.values())
+
+    def seconds_until_affordable(self, ticket):
+        return max(self.request_bucket.seconds_until(1), self.token_bucket.seconds_until(ticket["tokens"]))
+
+    def dispatch(self):
+        """Grants queued requests in fair order while the buckets can cover them. Call with the condition held."""
+        now = time.monotonic()
+        self.request_bucket.refill(now)
+        self.token_bucket.refill(now)
+        granted_any = False
+        for priority in sorted(self.queues):
+            users = self.queues[priority]
+            while users:
+                user_id, tickets = next(iter(users.items()))
+                ticket = tickets[0]
+                if self.seconds_until_affordable(ticket) > 0:
+                    break # The next request in line must wait; nobody may skip ahead of it
+                self.request_bucket.take(1)
+                self.token_bucket.take(ticket["tokens"])
+                ticket["granted"] = True
+                self.granted += 1
+                granted_any = True
+                tickets.popleft()
+                del users[user_id]
+                if tickets:
+                    users[user_id] = tickets # Back of the rotation
+            if users:
+                break # Lower priorities wait until this one is drained
+        for priority in [p for p, users in self.queues.items() if not users]:
+            del self.queues[priority]
+        if granted_any:
+            self.condition.notify_all()
+
+    def position(self, ticket):
+        """1-based position of a waiting ticket in the order requests will be granted."""
+        ahead = 0
+        for priority, users in self.queues.items():
+            if priority < ticket["priority"]:
+                ahead += sum(len(tickets) for tickets in users.values())
+        users = self.queues.get(ticket["priority"], {})
+        own_turn = users[ticket["user_id"]].index(ticket) # Round in which this ticket is served
+        before_own_user = True
+        for user_id, tickets in users.items():
+            if user_id == ticket["user_id"]:
+                before_own_user = False
+                ahead += own_turn
+            else:
+                ahead += min(len(tickets), own_turn) + (1 if before_own_user and len(tickets) > own_turn else 0)
+        return ahead + 1
+
+    def estimated_wait(self, position, tokens):
+        """Seconds until a request at `position` (each ahead of it assumed to cost `tokens`) can be granted."""
+        return max(self.request_bucket.seconds_until(position), self.token_bucket.seconds_until(position * tokens))
+
+    def acquire(self, user_id, tokens, priority=PRIORITY_INTERACTIVE, on_wait=None, timeout=MODEL_QUEUE_TIMEOUT):
+        """
+        Blocks until the request may be sent. `on_wait(position, eta_seconds)` is called (without the lock held)
+        whenever the position changes while waiting, and with (0, 0.0) once a request that had to wait is granted.
+        Returns the seconds spent waiting; raises QuotaTimeout after `timeout` seconds.
+        """
+        start_time = time.monotonic()
+        ticket = {"user_id": user_id or "anonymous", "tokens": tokens, "priority": priority, "granted": False}
+        last_position = None
+        with self.condition:
+            self.queues.setdefault(priority, OrderedDict()).setdefault(ticket["user_id"], deque()).append(ticket)
+            self.dispatch()
+            while not ticket["granted"]:
+                remaining = start_time + timeout - time.monotonic()
+                if remaining <= 0:
+                    tickets = self.queues[priority][ticket["user_id"]]
+                    tickets.remove(ticket)
+                    if not tickets:
+                        del self.queues[priority][ticket["user_id"]]
+                    self.timeouts += 1
+                    self.dispatch() # Requests behind this one may be affordable now
+                    get_metrics().increment("jake_model_queue_timeouts")
+                    raise QuotaTimeout(f"Waited {timeout:g}s for model quota")
+                position = self.position(ticket)
+                if on_wait and position != last_position:
+                    last_position = position
+                    eta = self.estimated_wait(position, tokens)
+                    self.condition.release()
+                    try:
+                        on_wait(position, eta)
+                    finally:
+                        self.condition.acquire()
+                    self.dispatch()
+                    continue
+                head_delay = min(self.seconds_until_affordable(users[next(iter(users))][0])
+                                 for users in self.queues.values() if users)
+                self.condition.wait(timeout=min(max(head_delay, 0.005), remaining, 1.0))
+                self.dispatch()
+        waited = time.monotonic() - start_time
+        get_metrics().observe("jake_model_queue_wait_seconds", waited, priority="interactive" if priority == PRIORITY_INTERACTIVE else "background")
+        if on_wait and last_position is not None:
+            on_wait(0, 0.0)
+        return waited
+
+    def penalize(self):
+        """The API answered 429 despite scheduling (e.g. quota shared with other processes): pause new grants."""
+        with self.condition:
+            self.request_bucket.refill(time.monotonic())
+            self.request_bucket.tokens = min(self.request_bucket.tokens, 0.0)
+
+    def stats(self):
+        with self.condition:
+            return {"queued": self.queued(), "granted": self.granted, "timeouts": self.timeouts}
+
+@process_singleton
+def get_model_scheduler():
+    """One scheduler per process: the quota belongs to the API key, not to a session."""
+    return ModelScheduler(MODEL_REQUESTS_PER_MINUTE, MODEL_TOKENS_PER_MINUTE)
+
+def request_token_estimate(payload):
+    """Estimated tokens a generateContent request uses: every text part of the prompt, plus room for the reply."""
+    prompt_tokens = sum(estimate_tokens(part.get("text", "")) for message in payload["contents"] for part in message["parts"])
+    return prompt_tokens + MODEL_OUTPUT_TOKEN_ESTIMATE
+
+# --- Gemini Backend Client ---
+class GeminiClient:
+    """
+    HTTP client for the Gemini API, meant to be created once per process (see get_gemini_client).
+    Reuses keep-alive connections from a pool, bounds every request with connect/read timeouts,
+    and retries 429/5xx responses and connection errors with jittered exponential backoff.
+    """
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+    def __init__(self, base_url, api_key, model, connect_timeout=5.0, read_timeout=60.0,
+                 max_retries=3, backoff_base=0.5, backoff_cap=8.0, pool_maxsize=10, scheduler=None):
+        self.base_url = base_url.rstrip("/")
+        self.scheduler = scheduler # Optional ModelScheduler every attempt (retries included) must pass
+        self.api_key = api_key
+        self.model = model
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+
+        self.session = requests.Session()
+        self.session.headers.update({"Content-Type": "application/json"})
+        # Retries are handled in post() so that backoff and Retry-After work the same for every method
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def method_url(self, method):
+        return f"{self.base_url}/models/{self.model}:{method}"
+
+    def backoff_delay(self, attempt, retry_after=None):
+        """Full-jitter exponential backoff; honours a numeric Retry-After header when the server sends one."""
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_cap)
+            except ValueError:
+                pass # HTTP-date form, fall back to our own schedule
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+
+    def post(self, method, payload, stream=False, params=None, user_id=None, priority=PRIORITY_INTERACTIVE, on_wait=None):
+        """
+        POSTs to a model method, retrying transient failures. Returns the successful requests.Response.
+        With a scheduler, each attempt first waits for quota (see ModelScheduler.acquire).
+        """
+        params = dict(params or {})
+        if self.api_key:
+            params["key"] = self.api_key
+        tokens = request_token_estimate(payload) if self.scheduler else 0
+        for attempt in range(self.max_retries + 1):
+            if self.scheduler:
+                self.scheduler.acquire(user_id, tokens, priority, on_wait if attempt == 0 else None)
+            try:
+                response = self.session.post(self.method_url(method), params=params, json=payload,
+                                             stream=stream, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self.backoff_delay(attempt))
+                continue
+            if response.status_code == 429 and self.scheduler:
+                self.scheduler.penalize()
+            if response.status_code in self.RETRY_STATUS_CODES and attempt < self.max_retries:
+                retry_after = response.headers.get("Retry-After")
+                response.close() # Hand the connection back to the pool before sleeping
+                time.sleep(self.backoff_delay(attempt, retry_after))
+                continue
+            response.raise_for_status() # Raise an HTTPError for bad responses (4xx or 5xx)
+            return response
+
+    def generate_content(self, payload, **schedule):
+        """Calls generateContent and returns the text of the first candidate. `schedule` is passed on to post()."""
+        result = self.post("generateContent", payload, **schedule).json()
+        candidates = result.get("candidates") or []
+        if candidates and candidates[0].get("content", {}).get("parts"):
+            return "".join(part.get("text", "") for part in candidates[0]["content"]["parts"])
+        return "I received an empty or malformed response from the AI model."
+
+    def stream_generate_content(self, payload, **schedule):
+        """Calls streamGenerateContent (server-sent events) and yields text chunks as they arrive."""
+        with self.post("streamGenerateContent", payload, stream=True, params={"alt": "sse"}, **schedule) as response:
+            for line in response.iter_lines(decode_unicode=True):
+                # Each event is a line like `data: {...GenerateContentResponse...}`
+                if not line or not line.startswith("data:"):
+                    continue
+                event = json.loads(line[len("data:"):])
+                candidates = event.get("candidates") or [{}]
+                for part in candidates[0].get("content", {}).get("parts", []):
+                    if part.get("text"):
+                        yield part["text"]
+
+@process_singleton
+def get_gemini_client():
+    """One client (and connection pool) per process, shared by all sessions."""
+    return GeminiClient(GEMINI_API_BASE_URL, GEMINI_API_KEY, GEMINI_MODEL, scheduler=get_model_scheduler(), **GEMINI_CLIENT_CONFIG)
+
+# --- Streaming Responses ---
+def reply_chunks(text):
+    """Splits a reply into word-sized chunks (each with its trailing whitespace), as the mock backend streams it."""
+    return re.findall(r"\S+\s*", text)
+
+def stream_mock_chunks(user_input, personality, user_preferences, learned_preferences=()):
+    """Yields the mock response word by word, with simulated model latency."""
+    jake_response_content = get_mock_response(user_input, personality, user_preferences, learned_preferences)
+    time.sleep(sample_mock_latency(MOCK_FIRST_TOKEN_DELAY)) # Simulate time until the model starts answering
+    for chunk in reply_chunks(jake_response_content):
+        yield chunk
+        if MOCK_CHUNK_DELAY_SCALE:
+            time.sleep(MOCK_CHUNK_DELAY * MOCK_CHUNK_DELAY_SCALE)
+
+def stream_reply(session, user_input, personality, on_finish=None, priority=PRIORITY_INTERACTIVE, on_queue=None):
+    """
+    Generator variant of generate_reply: yields the reply in chunks as the backend produces them.
+    Streams from the real API when a key is configured, otherwise from the mock backend.
+    `on_finish`, if given, is called with the turn summary (see finish_turn) once the stream ends.
+    A backend failure yields FALLBACK_REPLY only if no chunk was yielded yet; otherwise the partial reply is kept
+    as the summary's reply. Either way the summary's "error" is set.
+    """
+    turn = begin_turn(session, user_input, personality)
+    first_chunk_time = None
+    backend_start_time = None
+    received = []
+    error = None
+    completed = False # Stays False if the consumer closes the stream early (GeneratorExit is not an Exception)
+    try:
+        if turn["cached_reply"] is not None:
+            chunks = [turn["cached_reply"]]
+        else:
+            backend_start_time = time.perf_counter()
+            if USE_LIVE_BACKEND:
+                chunks = get_gemini_client().stream_generate_content(build_gemini_payload(turn["contents"]),
+                                                                     **model_schedule(session, priority, on_queue))
+            else:
+                chunks = stream_mock_chunks(user_input, personality, session.user_preferences, turn["learned_preferences"])
+        for chunk in chunks:
+            if first_chunk_time is None:
+                first_chunk_time = time.perf_counter()
+            received.append(chunk)
+            yield chunk
+        completed = True
+    except Exception as e:
+        error = str(e)
+        if not received: # Chunks already shown stay the reply as they are; the fallback would run into them
+            received = [FALLBACK_REPLY]
+            yield FALLBACK_REPLY
+    finally:
+        summary = finish_turn(session, turn, "".join(received), streamed=True, first_chunk_time=first_chunk_time,
+                              backend_start_time=backend_start_time, error=error, complete=completed)
+        if on_finish:
+            on_finish(summary)
+
+def record_turn_metrics(session, time_to_first_token, total_latency, streamed, cache_hit=False, error=None):
+    """Stores latency figures (in seconds) for the latest assistant turn, in the session and the process-wide metrics."""
+    session.turn_metrics.append({
+        "time_to_first_token": round(time_to_first_token, 4),
+        "total_latency": round(total_latency, 4),
+        "streamed": streamed,
+        "cache_hit": cache_hit,
+        "error": error,
+    })
+    metrics = get_metrics()
+    mode = "streamed" if streamed else "blocking"
+    metrics.observe("jake_time_to_first_token_seconds", time_to_first_token, mode=mode)
+    metrics.observe("jake_turn_duration_seconds", total_latency, mode=mode)
+    metrics.increment("jake_turns", mode=mode, cache="hit" if cache_hit else "miss")
@@ -0,0 +1,445 @@
+"""
+Jake's conversation engine (jake_engine.py) as an asyncio ASGI service, so model calls run outside the
+Streamlit script thread and the engine can be scaled separately from the UI.
+
+    python jake_engine_service.py --port 8700       # or: uvicorn jake_engine_service:app --port 8700
+    JAKE_ENGINE_URL=http://127.0.0.1:8700 streamlit run app,py.py
+
+API (JSON bodies):
+    PUT    /v1/sessions/{session_id}         Seeds a session: {"history": [[role, message], ...], "preferences": {topic: [values]}}
+    DELETE /v1/sessions/{session_id}
+    POST   /v1/sessions/{session_id}/reply   {"message": ..., "personality": {...}, "preferences": {...}, "stream": false,
+                                              "user_id": ..., "priority": "interactive" | "background"}
+           Returns the turn summary of jake_engine.finish_turn. With "stream": true the response is a
+           text/event-stream of `data: {"text": ...}` events, ended by an `event: done` event carrying the summary.
+           While the request waits for model quota, `event: queue` events report {"position": ..., "eta": seconds}.
+           Personality settings left out default to jake_engine.DEFAULT_PERSONALITY. Invalid bodies get 400, and
+           sessions that were never seeded, or were dropped (idle, evicted, service restart), get 404.
+    GET    /healthz, GET /metrics (OpenMetrics)
+
+One worker serves many sessions at once: the mock backend waits with asyncio.sleep and blocking live
+calls run in a thread pool. At most --max-concurrency backend calls run at a time, up to --max-queued
+more wait for a slot, and requests beyond that get 503 with a Retry-After header.
+"""
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing, asynccontextmanager
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Route
+
+import jake_engine as engine
+
+ENGINE_MAX_CONCURRENCY = int(os.environ.get("JAKE_ENGINE_MAX_CONCURRENCY", "32")) # Backend calls in flight
+ENGINE_MAX_QUEUED = int(os.environ.get("JAKE_ENGINE_MAX_QUEUED", "256")) # Requests waiting for a backend slot
+ENGINE_MAX_SESSIONS = int(os.environ.get("JAKE_ENGINE_MAX_SESSIONS", "10000")) # Least recently used sessions are dropped beyond this
+ENGINE_SESSION_TTL = float(os.environ.get("JAKE_ENGINE_SESSION_TTL", "3600")) # Seconds of inactivity before a session is dropped
+ENGINE_TURN_METRICS_KEPT = 50 # Per-session latency records kept in memory
+
+
+class EngineOverloaded(Exception):
+    """Raised when a request would exceed the backend queue bound."""
+
+
+class ConcurrencyLimiter:
+    """Bounds the backend calls running at once, and the requests allowed to wait for one."""
+
+    def __init__(self, max_concurrency, max_queued):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_queued = max_queued
+        self.active = 0
+        self.waiting = 0
+
+    def is_full(self):
+        return self.semaphore.locked() and self.waiting >= self.max_queued
+
+    @asynccontextmanager
+    async def slot(self):
+        if self.is_full():
+            raise EngineOverloaded()
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self.semaphore.release()
+
+
+class ServiceSession(engine.ConversationSession):
+    """A ConversationSession plus a lock, so one session's turns run one at a time and in order."""
+
+    def __init__(self):
+        super().__init__(turn_metrics_kept=ENGINE_TURN_METRICS_KEPT)
+        self.lock = asyncio.Lock()
+        self.last_used = time.monotonic()
+
+
+class SessionRegistry:
+    """Sessions by id, dropped when idle for longer than `ttl_seconds` or least recently used beyond `max_sessions`."""
+
+    def __init__(self, max_sessions, ttl_seconds):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.sessions = OrderedDict() # session id -> ServiceSession, least recently used first
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def expire(self, now):
+        while self.sessions:
+            oldest_id, oldest = next(iter(self.sessions.items()))
+            if now - oldest.last_used < self.ttl_seconds or oldest.lock.locked():
+                break
+            del self.sessions[oldest_id]
+
+    def find(self, session_id):
+        """The session with this id, or None if it was never seeded, expired, was evicted or lost in a restart."""
+        now = time.monotonic()
+        self.expire(now)
+        session = self.sessions.get(session_id)
+        if session is not None:
+            self.sessions.move_to_end(session_id)
+            session.last_used = now
+        return session
+
+    def get(self, session_id):
+        """The session with this id, created if it doesn't exist."""
+        now = time.monotonic()
+        self.expire(now)
+        session = self.sessions.get(session_id)
+        if session is None:
+            session = self.sessions[session_id] = ServiceSession()
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        self.sessions.move_to_end(session_id)
+        session.last_used = now
+        return session
+
+    def replace(self, session_id):
+        self.sessions.pop(session_id, None)
+        return self.get(session_id)
+
+    def drop(self, session_id):
+        return self.sessions.pop(session_id, None) is not None
+
+
+def bad_request(message):
+    return JSONResponse({"error": message}, status_code=400)
+
+
+async def read_json_object(request):
+    """The request's JSON body, or None if it is not a JSON object."""
+    try:
+        body = await request.json()
+    except ValueError:
+        return None
+    return body if isinstance(body, dict) else None
+
+
+def valid_preferences(preferences):
+    """Preferences must be {topic: [value, ...]} with string topics and values (or missing)."""
+    if preferences is None:
+        return True
+    return isinstance(preferences, dict) and all(
+        isinstance(topic, str) and isinstance(values, list) and all(isinstance(value, str) for value in values)
+        for topic, values in preferences.items()
+    )
+
+
+def valid_personality(personality):
+    """Personality settings must be known ones, each with the type of its default (a string or null where that is null)."""
+    if not isinstance(personality, dict):
+        return False
+    for name, value in personality.items():
+        if name not in engine.DEFAULT_PERSONALITY:
+            return False
+        default = engine.DEFAULT_PERSONALITY[name]
+        if type(value) not in ((str, type(None)) if default is None else (type(default),)): # type(), so True is not an int
+            return False
+    return True
+
+
+def learn_preferences(session, preferences):
+    """
+    Adds preferences known to the client (e.g. loaded from its database). Clients send all of them with every
+    turn, so the ones the session already knows are skipped before they reach learn_preference.
+    """
+    for topic, values in (preferences or {}).items():
+        known = set(session.user_preferences.get(topic, ()))
+        for value in values:
+            if value not in known:
+                engine.learn_preference(session, topic, value)
+                known.add(value)
+
+
+async def backend_chunks(session, turn, streamed, priority, executor):
+    """
+    Async iterator over ("chunk", text) events from the backend (word-sized chunks when streaming, else one),
+    and ("queue", {"position", "eta"}) events while a streamed live request waits for model quota.
+    """
+    if not engine.USE_LIVE_BACKEND:
+        reply = engine.get_mock_response(turn["user_input"], turn["personality"], session.user_preferences, turn["learned_preferences"])
+        if not streamed:
+            await asyncio.sleep(engine.sample_mock_latency(engine.MOCK_RESPONSE_DELAY))
+            yield "chunk", reply
+            return
+        await asyncio.sleep(engine.sample_mock_latency(engine.MOCK_FIRST_TOKEN_DELAY))
+        for chunk in engine.reply_chunks(reply):
+            yield "chunk", chunk
+            if engine.MOCK_CHUNK_DELAY_SCALE:
+                await asyncio.sleep(engine.MOCK_CHUNK_DELAY * engine.MOCK_CHUNK_DELAY_SCALE)
+        return
+
+    # The Gemini client is blocking (requests), so it runs in the thread pool; waiting for quota happens there too
+    client = engine.get_gemini_client()
+    payload = engine.build_gemini_payload(turn["contents"])
+    loop = asyncio.get_running_loop()
+    if not streamed:
+        schedule = engine.model_schedule(session, priority, None)
+        yield "chunk", await loop.run_in_executor(executor, lambda: client.generate_content(payload, **schedule))
+        return
+    queue = asyncio.Queue()
+    end_of_stream = object()
+    stopped = threading.Event() # Set when the consumer goes away, so the thread stops reading the model's stream
+
+    def report_queue_position(position, eta):
+        loop.call_soon_threadsafe(queue.put_nowait, ("queue", {"position": position, "eta": round(eta, 1)}))
+
+    def pump():
+        chunks = client.stream_generate_content(payload, **engine.model_schedule(session, priority, report_queue_position))
+        try:
+            for chunk in chunks:
+                if stopped.is_set():
+                    return
+                loop.call_soon_threadsafe(queue.put_nowait, ("chunk", chunk))
+            loop.call_soon_threadsafe(queue.put_nowait, end_of_stream)
+        except Exception as e:
+            if not stopped.is_set():
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+        finally:
+            chunks.close() # Closes the HTTP response when the stream is abandoned
+
+    executor.submit(pump)
+    try:
+        while (item := await queue.get()) is not end_of_stream:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stopped.set()
+
+
+async def run_turn(service, session, message, personality, streamed, priority=engine.PRIORITY_INTERACTIVE):
+    """
+    One chat turn, as ("chunk", text) and ("queue", position) events followed by a final ("done", summary).
+    Prompt assembly and caching run on the event loop (they are CPU-only and fast);
+    only the backend call waits for a slot from the concurrency limiter.
+    If the client goes away mid-turn, the part of the reply it received is kept in the history (but not cached);
+    if it received none, the turn is dropped from the history.
+    """
+    async with session.lock:
+        session.chat_history.append(("user", message, None))
+        try:
+            turn = engine.begin_turn(session, message, personality)
+        except Exception:
+            session.chat_history.pop() # Leaves the session as it was; the request fails
+            raise
+        first_chunk_time = None
+        backend_start_time = None
+        received = []
+        error = None
+        rejected = False # The limiter turned the request away, so the turn never happened
+        completed = False # Stays False if the client disconnects (GeneratorExit and CancelledError are not Exceptions)
+        try:
+            if turn["cached_reply"] is not None:
+                first_chunk_time = time.perf_counter()
+                received.append(turn["cached_reply"])
+                yield "chunk", turn["cached_reply"]
+            else:
+                async with service.limiter.slot():
+                    backend_start_time = time.perf_counter()
+                    async with aclosing(backend_chunks(session, turn, streamed, priority, service.executor)) as chunks:
+                        async for kind, data in chunks:
+                            if kind == "chunk":
+                                if first_chunk_time is None:
+                                    first_chunk_time = time.perf_counter()
+                                received.append(data)
+                            yield kind, data
+            completed = True
+        except EngineOverloaded:
+            rejected = True
+            raise
+        except Exception as e:
+            error = str(e)
+            if not received: # Chunks already sent stay the reply as they are, as in jake_engine.stream_reply
+                received = [engine.FALLBACK_REPLY]
+                yield "chunk", engine.FALLBACK_REPLY
+        finally:
+            summary = None
+            if not rejected:
+                summary = engine.finish_turn(session, turn, "".join(received), streamed, first_chunk_time=first_chunk_time,
+                                             backend_start_time=backend_start_time, error=error, complete=completed)
+            if summary and summary["reply"]:
+                session.chat_history.append(("assistant", summary["reply"], None))
+            else:
+                session.chat_history.pop() # The turn never happened, or the client left before any of the reply arrived
+        yield "done", summary
+
+
+def overloaded_response():
+    engine.get_metrics().increment("jake_engine_rejected_requests")
+    return JSONResponse({"error": "Too many requests are waiting for the model; try again shortly."}, status_code=503,
+                        headers={"Retry-After": "1"})
+
+
+def sse_event(data, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+
+async def reply(request):
+    service = request.app.state.service
+    body = await read_json_object(request)
+    if body is None:
+        return bad_request("The body must be a JSON object")
+    message = body.get("message")
+    personality = body.get("personality", {})
+    if not isinstance(message, str) or not message.strip():
+        return bad_request('"message" must be a non-empty string')
+    if not valid_personality(personality):
+        return bad_request(f'"personality" must be an object of settings ({", ".join(engine.DEFAULT_PERSONALITY)}) '
+                           'with the types of jake_engine.DEFAULT_PERSONALITY')
+    if not valid_preferences(body.get("preferences")):
+        return bad_request('"preferences" must map topics to lists of strings')
+    personality = {**engine.DEFAULT_PERSONALITY, **personality} # Settings the client leaves out keep their defaults
+    if service.limiter.is_full():
+        return overloaded_response()
+
+    priority = engine.PRIORITY_BACKGROUND if body.get("priority") == "background" else engine.PRIORITY_INTERACTIVE
+
+    session = service.sessions.find(request.path_params["session_id"])
+    if session is None:
+        # Answering without the conversation would silently lose its history; the client re-seeds it with PUT
+        return JSONResponse({"error": "Unknown session; seed it with PUT /v1/sessions/{session_id} first"}, status_code=404)
+    session.user_id = body.get("user_id") or request.path_params["session_id"] # Model quota is shared fairly per user
+    learn_preferences(session, body.get("preferences"))
+    events = run_turn(service, session, message, personality, streamed=bool(body.get("stream")), priority=priority)
+
+    if not body.get("stream"):
+        summary = None
+        try:
+            async for kind, data in events: # Consumed to the end, so the session lock is released
+                if kind == "done":
+                    summary = data
+        except EngineOverloaded:
+            return overloaded_response()
+        return JSONResponse(summary)
+
+    async def event_stream():
+        try:
+            async with aclosing(events): # Finishes the turn at once if the client disconnects
+                async for kind, data in events:
+                    yield sse_event({"text": data}) if kind == "chunk" else sse_event(data, kind)
+        except EngineOverloaded:
+            engine.get_metrics().increment("jake_engine_rejected_requests")
+            yield sse_event({"error": "Too many requests are waiting for the model; try again shortly."}, "error")
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+async def put_session(request):
+    service = request.app.state.service
+    body = await read_json_object(request)
+    if body is None:
+        return bad_request("The body must be a JSON object")
+    history = body.get("history") or []
+    if not isinstance(history, list) or not all(
+            isinstance(entry, list) and len(entry) >= 2 and entry[0] in ("user", "assistant") and isinstance(entry[1], str)
+            for entry in history):
+        return bad_request('"history" must be a list of [role, message] pairs')
+    if not valid_preferences(body.get("preferences")):
+        return bad_request('"preferences" must map topics to lists of strings')
+    session = service.sessions.replace(request.path_params["session_id"])
+    session.chat_history = engine.ChatHistory((role, message, None) for role, message, *_ in history)
+    learn_preferences(session, body.get("preferences"))
+    return JSONResponse({"messages": len(session.chat_history), "preferences": sum(map(len, session.user_preferences.values()))})
+
+
+async def delete_session(request):
+    dropped = request.app.state.service.sessions.drop(request.path_params["session_id"])
+    return JSONResponse({"deleted": dropped})
+
+
+async def healthz(request):
+    service = request.app.state.service
+    return JSONResponse({
+        "status": "ok",
+        "backend": "gemini" if engine.USE_LIVE_BACKEND else "mock",
+        "sessions": len(service.sessions),
+        "active": service.limiter.active,
+        "waiting": service.limiter.waiting,
+        "model_quota": engine.get_model_scheduler().stats(),
+    })
+
+
+async def metrics(request):
+    return PlainTextResponse(engine.get_metrics().render_openmetrics(),
+                             media_type="application/openmetrics-text; version=1.0.0; charset=utf-8")
+
+
+class EngineService:
+    """State shared by all requests of one worker."""
+
+    def __init__(self, max_concurrency, max_queued, max_sessions, session_ttl):
+        self.limiter = ConcurrencyLimiter(max_concurrency, max_queued)
+        self.sessions = SessionRegistry(max_sessions, session_ttl)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="jake-backend")
+
+
+def create_app(max_concurrency=ENGINE_MAX_CONCURRENCY, max_queued=ENGINE_MAX_QUEUED,
+               max_sessions=ENGINE_MAX_SESSIONS, session_ttl=ENGINE_SESSION_TTL):
+    @asynccontextmanager
+    async def lifespan(app):
+        yield
+        app.state.service.executor.shutdown(wait=False, cancel_futures=True)
+
+    app = Starlette(routes=[
+        Route("/v1/sessions/{session_id}", put_session, methods=["PUT"]),
+        Route("/v1/sessions/{session_id}", delete_session, methods=["DELETE"]),
+        Route("/v1/sessions/{session_id}/reply", reply, methods=["POST"]),
+        Route("/healthz", healthz),
+        Route("/metrics", metrics),
+    ], lifespan=lifespan)
+    app.state.service = EngineService(max_concurrency, max_queued, max_sessions, session_ttl)
+    return app
+
+
+app = create_app()
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Serve Jake's conversation engine over HTTP (JSON and server-sent events).")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8700)
+    parser.add_argument("--max-concurrency", type=int, default=ENGINE_MAX_CONCURRENCY, help="Backend calls in flight at once")
+    parser.add_argument("--max-queued", type=int, default=ENGINE_MAX_QUEUED, help="Requests allowed to wait for a backend slot")
+    args = parser.parse_args()
+    uvicorn.run(create_app(args.max_concurrency, args.max_queued), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
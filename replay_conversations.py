@@ -0,0 +1,199 @@
+"""
+Offline batch replay of conversation corpora through Jake's engine, for regression-testing personality
+settings, prompt assembly and preference learning without chatting through the UI.
+
+Every conversation in a JSONL corpus is played turn by turn through jake_engine.generate_reply (the engine
+behind the app's get_gemini_response) in a fresh ConversationSession. Conversations are sharded across
+worker processes; the corpus is read, and results are written, as a stream in corpus order.
+
+    python replay_conversations.py corpus.jsonl --workers 8 --output replies.jsonl
+    python replay_conversations.py corpus.jsonl --personality '{"humor_style": "Sarcastic", "empathy": 3}'
+    python replay_conversations.py corpus.jsonl --stub --stub-latency 0.05    # Real client against gemini_stub_server.py
+
+Corpus lines: a JSON list of user messages, or {"id": ..., "messages": [...], "personality": {...}} where "id"
+(default: the line number) and "personality" (merged over --personality) are optional. Output lines, one per
+conversation: {"id", "turns": [{"user", "reply", "learned_preferences", "prompt_tokens", "cache_hit",
+"latency", "error"}], "preferences", "prompt_tokens", "seconds"}. Throughput stats are printed to stderr.
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from benchmark_app import percentiles
+
+IN_FLIGHT_PER_WORKER = 4 # Conversations queued per worker; bounds memory however large the corpus is
+
+
+def iter_conversations(path):
+    """Yields (id, messages, personality overrides) for each line of the corpus, reading it lazily."""
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if isinstance(record, list):
+                record = {"messages": record}
+            yield record.get("id", line_number), record["messages"], record.get("personality") or {}
+
+
+def init_worker(response_cache):
+    import jake_engine as engine
+
+    # The process-wide response cache makes replies depend on which conversations shared a worker
+    engine.RESPONSE_CACHE_ENABLED = response_cache
+
+
+def replay_conversation(conversation_id, messages, personality, seed):
+    """Plays one conversation through the engine in a fresh session, the way the app handles each chat message."""
+    import jake_engine as engine
+
+    random.seed(f"{seed}:{conversation_id}") # Mock replies depend on the conversation, not on the worker it ran in
+    session = engine.ConversationSession(user_id=f"replay-{conversation_id}")
+    turns = []
+    start_time = time.perf_counter()
+    for message in messages:
+        session.chat_history.append(("user", message, None))
+        summary = engine.generate_reply(session, message, personality, priority=engine.PRIORITY_BACKGROUND)
+        session.chat_history.append(("assistant", summary["reply"], None))
+        turns.append({
+            "user": message,
+            "reply": summary["reply"],
+            "learned_preferences": summary["learned_preferences"],
+            "prompt_tokens": summary["prompt_tokens"],
+            "cache_hit": summary["cache_hit"],
+            "latency": round(summary["total_latency"], 4),
+            "error": summary["error"],
+        })
+    return {
+        "id": conversation_id,
+        "turns": turns,
+        "preferences": session.user_preferences,
+        "prompt_tokens": sum(turn["prompt_tokens"] for turn in turns),
+        "seconds": round(time.perf_counter() - start_time, 4),
+    }
+
+
+def replay(conversations, personality, workers, seed, response_cache):
+    """Yields replayed conversations in corpus order, with at most IN_FLIGHT_PER_WORKER per worker submitted ahead."""
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(response_cache,)) as pool:
+        in_flight = deque()
+        for conversation_id, messages, overrides in conversations:
+            in_flight.append(pool.submit(replay_conversation, conversation_id, messages, {**personality, **overrides}, seed))
+            if len(in_flight) >= workers * IN_FLIGHT_PER_WORKER:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+def load_personality(value):
+    """--personality is a JSON object or the path of a file containing one."""
+    if not value:
+        return {}
+    if os.path.exists(value):
+        with open(value, encoding="utf-8") as f:
+            return json.load(f)
+    return json.loads(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a JSONL corpus of conversations through jake_engine.")
+    parser.add_argument("corpus", help="JSONL file, one conversation per line")
+    parser.add_argument("--output", default="-", help="JSONL file for the replayed conversations (default: stdout)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Worker processes")
+    parser.add_argument("--limit", type=int, help="Replay only the first N conversations")
+    parser.add_argument("--personality", help="JSON object (or file) of settings merged over jake_engine.DEFAULT_PERSONALITY")
+    parser.add_argument("--seed", default="0", help="Seed of the mock backend's reply choices")
+    parser.add_argument("--response-cache", action="store_true", help="Enable the response cache (off by default, so results don't depend on sharding)")
+    parser.add_argument("--latency", default="none",
+                        help='Mock latency model (JAKE_MOCK_LATENCY): "none", "fixed:S", "uniform:LO,HI", "lognormal:MEDIAN,SIGMA" or "default"')
+    parser.add_argument("--stub", action="store_true", help="Use the real Gemini client against an in-process gemini_stub_server")
+    parser.add_argument("--stub-url", help="Use the real Gemini client against a running stub, e.g. http://127.0.0.1:8765/v1beta")
+    parser.add_argument("--stub-latency", type=float, default=0.0)
+    parser.add_argument("--model-rpm", type=int, default=0, help="Model requests per minute, split across workers (0: unlimited)")
+    parser.add_argument("--model-tpm", type=int, default=0, help="Model tokens per minute, split across workers (0: unlimited)")
+    parser.add_argument("--json", help="Write the throughput stats to this file")
+    args = parser.parse_args()
+
+    # The engine reads these when it is imported, so they must be set before the workers start
+    os.environ["JAKE_MOCK_LATENCY"] = args.latency
+    os.environ["JAKE_MODEL_RPM"] = str(math.ceil(args.model_rpm / args.workers)) # Each worker has its own scheduler
+    os.environ["JAKE_MODEL_TPM"] = str(math.ceil(args.model_tpm / args.workers))
+    stub = None
+    if args.stub:
+        from gemini_stub_server import make_server
+        stub = make_server(port=0, latency=args.stub_latency, chunk_delay=0.0)
+        threading.Thread(target=stub.serve_forever, daemon=True).start()
+        os.environ["GEMINI_API_BASE_URL"] = f"http://127.0.0.1:{stub.server_address[1]}/v1beta"
+    elif args.stub_url:
+        os.environ["GEMINI_API_BASE_URL"] = args.stub_url
+
+    try:
+        import jake_engine as engine
+    except ValueError as e: # E.g. an invalid --latency, rejected when the engine reads its configuration
+        parser.error(str(e))
+    personality = {**engine.DEFAULT_PERSONALITY, **load_personality(args.personality)}
+    conversations = itertools.islice(iter_conversations(args.corpus), args.limit)
+
+    turn_seconds = []
+    prompt_tokens = []
+    counts = {"conversations": 0, "turns": 0, "preferences_extracted": 0, "cache_hits": 0, "errors": 0}
+    output = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    started = time.perf_counter()
+    try:
+        for result in replay(conversations, personality, args.workers, args.seed, args.response_cache):
+            output.write(json.dumps(result) + "\n")
+            counts["conversations"] += 1
+            for turn in result["turns"]:
+                counts["turns"] += 1
+                counts["preferences_extracted"] += len(turn["learned_preferences"])
+                counts["cache_hits"] += turn["cache_hit"]
+                counts["errors"] += turn["error"] is not None
+                turn_seconds.append(turn["latency"])
+                if not turn["cache_hit"]:
+                    prompt_tokens.append(turn["prompt_tokens"])
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    elapsed = time.perf_counter() - started
+
+    report = {
+        **counts,
+        "backend": "stub" if engine.USE_LIVE_BACKEND else f"mock ({args.latency})",
+        "workers": args.workers,
+        "wall_seconds": elapsed,
+        "conversations_per_second": counts["conversations"] / elapsed,
+        "turns_per_second": counts["turns"] / elapsed,
+        "turn_ms": {k: v * 1000 if k != "count" else v for k, v in percentiles(turn_seconds).items()},
+        "prompt_tokens": percentiles(prompt_tokens),
+    }
+    if stub:
+        report["stub_stats"] = stub.stats.snapshot()
+        stub.shutdown()
+
+    print(f"{counts['conversations']} conversations ({counts['turns']} turns) in {elapsed:.1f}s with {args.workers} workers: "
+          f"{report['conversations_per_second']:.1f} conversations/s, {report['turns_per_second']:.1f} turns/s, backend: {report['backend']}",
+          file=sys.stderr)
+    for name in ("turn_ms", "prompt_tokens"):
+        stats = report[name]
+        if stats["count"]:
+            print(f"  {name:<14} p50 {stats['p50']:9.2f}  p95 {stats['p95']:9.2f}  p99 {stats['p99']:9.2f}  max {stats['max']:9.2f}  (n={stats['count']})",
+                  file=sys.stderr)
+    print(f"  preferences extracted: {counts['preferences_extracted']}, cache hits: {counts['cache_hits']}, errors: {counts['errors']}",
+          file=sys.stderr)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if counts["errors"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# The engine reads its configuration from the environment when it is imported
+os.environ.setdefault("JAKE_MOCK_LATENCY", "none")
+os.environ.setdefault("JAKE_MOCK_CHUNK_DELAY_SCALE", "0")
+os.environ.pop("GEMINI_API_BASE_URL", None) # Always the mock backend
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,68 @@
+import gc
+import os
+
+import pytest
+
+import jake_engine as engine
+
+
+def records(start, stop):
+    return [("user" if i % 2 == 0 else "assistant", f"message {i}", f"avatar-{i % 3}" if i % 2 else None) for i in range(start, stop)]
+
+
+def new_history(tmp_path, items=(), memory_messages=8):
+    return engine.ChatHistory(items, memory_messages=memory_messages, spill_dir=str(tmp_path))
+
+
+def test_behaves_like_a_list_without_spilling(tmp_path):
+    items = records(0, 5)
+    history = new_history(tmp_path, items)
+    assert list(history) == items
+    assert history[-1] == items[-1]
+    assert history[1:4] == items[1:4]
+    assert history.spill_file is None
+
+
+def test_round_trips_across_the_spill_file(tmp_path):
+    items = records(0, 30)
+    history = new_history(tmp_path, items)
+    assert len(history.messages) <= 8
+    assert len(history.spill_offsets) > 0
+    assert len(history) == len(items)
+    assert list(history) == items
+    assert history[0] == items[0]
+    assert history[-1] == items[-1]
+    assert history[::-3] == items[::-3]
+    with pytest.raises(IndexError):
+        history[len(items)]
+
+
+@pytest.mark.parametrize("existing", [3, 30], ids=["in memory", "spilled"])
+def test_prepend(tmp_path, existing):
+    history = new_history(tmp_path, records(20, 20 + existing))
+    revision = history.revision
+    history.prepend(records(0, 20))
+    assert list(history) == records(0, 20 + existing)
+    assert history.revision == revision + 1
+    history.prepend([])
+    assert history.revision == revision + 1
+
+
+def test_pop_across_the_spill_boundary(tmp_path):
+    items = records(0, 30)
+    history = new_history(tmp_path, items)
+    popped = [history.pop() for _ in items]
+    assert popped == items[::-1]
+    assert len(history) == 0
+    with pytest.raises(IndexError):
+        history.pop()
+    history.append(items[0])
+    assert list(history) == items[:1]
+
+
+def test_spill_file_is_deleted_with_the_history(tmp_path):
+    history = new_history(tmp_path, records(0, 30))
+    assert os.listdir(tmp_path)
+    del history
+    gc.collect()
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,224 @@
+import threading
+
+import pytest
+
+import jake_engine as engine
+
+
+def new_session():
+    return engine.ConversationSession()
+
+
+def ask(session, message, stream=False):
+    session.chat_history.append(("user", message, None))
+    if stream:
+        return "".join(engine.stream_reply(session, message, dict(engine.DEFAULT_PERSONALITY)))
+    return engine.generate_reply(session, message, dict(engine.DEFAULT_PERSONALITY))["reply"]
+
+
+# --- Response cache ---
+def test_stream_closed_early_is_not_cached():
+    message = "is a stream closed early cached?"
+    session = new_session()
+    session.chat_history.append(("user", message, None))
+    stream = engine.stream_reply(session, message, dict(engine.DEFAULT_PERSONALITY))
+    partial = next(stream)
+    stream.close() # What Streamlit does when the user interrupts the rerun
+    assert session.response_cache.stats()["entries"] == 0
+
+    other = new_session()
+    other.chat_history.append(("user", message, None))
+    summary = engine.generate_reply(other, message, dict(engine.DEFAULT_PERSONALITY))
+    assert not summary["cache_hit"]
+    assert summary["reply"] != partial
+
+
+def test_completed_stream_is_cached():
+    message = "is a completed stream cached?"
+    reply = ask(new_session(), message, stream=True)
+    other = new_session()
+    other.chat_history.append(("user", message, None))
+    summary = engine.generate_reply(other, message, dict(engine.DEFAULT_PERSONALITY))
+    assert summary["cache_hit"]
+    assert summary["reply"] == reply
+
+
+def session_with_history(*messages):
+    """A session whose history alternates the given user messages with a fixed reply."""
+    session = new_session()
+    for message in messages:
+        session.chat_history.extend([("user", message, None), ("assistant", "I see.", None)])
+    return session
+
+
+def reply_summary(session, message):
+    session.chat_history.append(("user", message, None))
+    return engine.generate_reply(session, message, dict(engine.DEFAULT_PERSONALITY))
+
+
+def test_reply_is_not_shared_with_a_different_earlier_conversation():
+    question = "what should we talk about next?"
+    reply_summary(session_with_history("my day at the office was long", "the meeting went badly"), question)
+    summary = reply_summary(session_with_history("i just got back from the beach", "the meeting went badly"), question)
+    assert not summary["cache_hit"]
+
+
+def test_reply_is_shared_with_the_same_conversation():
+    question = "and what do you think of that?"
+    messages = ("the weather turned cold", "it snowed all night")
+    reply = reply_summary(session_with_history(*messages), question)["reply"]
+    summary = reply_summary(session_with_history(*messages), question)
+    assert summary["cache_hit"]
+    assert summary["reply"] == reply
+
+
+# --- Streaming ---
+def failing_chunks(*args, **kwargs):
+    yield "Hello "
+    yield "there"
+    raise ConnectionError("stream dropped")
+
+
+def test_stream_failing_midway_keeps_the_partial_reply(monkeypatch):
+    monkeypatch.setattr(engine, "stream_mock_chunks", failing_chunks)
+    session = new_session()
+    session.chat_history.append(("user", "tell me a story", None))
+    summaries = []
+    shown = "".join(engine.stream_reply(session, "tell me a story", dict(engine.DEFAULT_PERSONALITY), on_finish=summaries.append))
+    assert shown == "Hello there"
+    assert summaries[0]["reply"] == shown
+    assert summaries[0]["error"] == "stream dropped"
+
+
+def test_stream_failing_before_any_chunk_shows_the_fallback(monkeypatch):
+    def no_chunks(*args, **kwargs):
+        raise ConnectionError("no connection")
+        yield
+
+    monkeypatch.setattr(engine, "stream_mock_chunks", no_chunks)
+    session = new_session()
+    session.chat_history.append(("user", "tell me a story", None))
+    summaries = []
+    shown = "".join(engine.stream_reply(session, "tell me a story", dict(engine.DEFAULT_PERSONALITY), on_finish=summaries.append))
+    assert shown == summaries[0]["reply"] == engine.FALLBACK_REPLY
+
+
+# --- Preference extraction ---
+@pytest.mark.parametrize("message, expected", [
+    ("My favorite color is blue.", [("favorite_color", "blue")]),
+    ("I like sci-fi movies", [("movie_genre", "sci-fi")]),
+    ("My hobby is rock climbing", [("hobby", "rock climbing")]),
+    ("I like rock music and horror movies", [("music_genre", "rock"), ("movie_genre", "horror")]),
+    ("I love jazz music, old french films, and also punk music", [("music_genre", "jazz"), ("movie_genre", "old french"),
+                                                                  ("music_genre", "punk")]),
+    ("I hate jazz music and horror movies", []),
+    ("My favorite food is pad thai and horror movies", [("favorite_food", "pad thai")]),
+    ("I like rock music and I love horror movies", [("music_genre", "rock"), ("movie_genre", "horror")]),
+    ("I love jazz music and my favorite food is ramen", [("music_genre", "jazz"), ("favorite_food", "ramen")]),
+    ("My favorite food is pad thai and my hobby is chess", [("favorite_food", "pad thai"), ("hobby", "chess")]),
+    ("My hobby is painting because it relaxes me", [("hobby", "painting")]),
+    ("My favourite colour is green, I really enjoy old french films", [("favorite_color", "green"), ("movie_genre", "old french")]),
+    ("I like it when we talk about movies", []),
+])
+def test_extract_preferences(message, expected):
+    assert engine.extract_preferences(message) == expected
+
+
+def test_backfill_does_not_match_across_messages():
+    session = new_session()
+    found = engine.backfill_preferences(session, [("user", "I like rock", None), ("user", "music is great", None),
+                                                  ("user", "My hobby is chess", None)])
+    assert found == [("hobby", "chess")]
+
+
+# --- Prompt size ---
+def prompt_tokens_with_preferences(count):
+    session = new_session()
+    for i in range(count):
+        engine.learn_preference(session, ("hobby", "favorite_food", "movie_genre")[i % 3], f"thing number {i:03d}")
+    ask(session, "What do you remember about my hobby?")
+    return session.prompt_builder.last_prompt_tokens
+
+
+def test_prompt_size_does_not_grow_with_preferences():
+    assert prompt_tokens_with_preferences(200) == prompt_tokens_with_preferences(50)
+    assert prompt_tokens_with_preferences(200) < 600
+
+
+def prompt_texts(session, message):
+    session.chat_history.append(("user", message, None))
+    contents = engine.build_gemini_contents(session, message, dict(engine.DEFAULT_PERSONALITY))
+    return [part["text"] for content in contents for part in content["parts"]]
+
+
+def test_current_message_is_sent_once():
+    session = new_session()
+    texts = prompt_texts(session, "hello there")
+    assert texts[1:] == ["hello there"]
+    session.chat_history.append(("assistant", "hi!", None))
+    texts = prompt_texts(session, "how are you")
+    assert texts[1:] == ["hello there", "hi!", "how are you"]
+
+
+def test_current_message_is_not_counted_twice():
+    session = new_session()
+    prompt_texts(session, "word " * 400)
+    system_tokens = session.prompt_builder.system_tokens
+    assert session.prompt_builder.last_prompt_tokens == system_tokens + engine.estimate_tokens("word " * 400)
+
+
+@pytest.mark.parametrize("spec, expected", [
+    ("default", ("default", ())),
+    ("none", ("none", ())),
+    ("fixed:0.5", ("fixed", (0.5,))),
+    ("uniform:0.1,0.3", ("uniform", (0.1, 0.3))),
+    ("lognormal:0.8,0.5", ("lognormal", (0.8, 0.5))),
+])
+def test_parse_mock_latency_model(spec, expected):
+    assert engine.parse_mock_latency_model(spec) == expected
+
+
+@pytest.mark.parametrize("spec", [
+    "bogus", "fixed", "fixed:fast", "fixed:1,2", "uniform:1", "uniform:0.3,0.1", "fixed:-1", "fixed:nan", "lognormal:0,0.5",
+])
+def test_parse_mock_latency_model_rejects_invalid_specs(spec):
+    with pytest.raises(ValueError):
+        engine.parse_mock_latency_model(spec)
+
+
+def test_known_preference_is_not_remembered_again(monkeypatch):
+    session = new_session()
+    engine.learn_preference(session, "hobby", "climbing")
+    version = session.user_knowledge_version
+    added = []
+    monkeypatch.setattr(session.long_term_memory_snippets, "add", added.append)
+    engine.learn_preference(session, "hobby", "climbing")
+    assert added == []
+    assert session.user_knowledge_version == version
+    assert session.user_preferences == {"hobby": ["climbing"]}
+
+
+# --- Metrics ---
+def test_concurrent_metrics_file_exports(tmp_path):
+    registry = engine.MetricsRegistry()
+    registry.increment("jake_turns", mode="blocking", cache="miss")
+    path = str(tmp_path / "metrics.txt")
+    errors = []
+    start = threading.Barrier(8)
+
+    def export():
+        start.wait()
+        try:
+            for _ in range(50):
+                registry.export_to_file(path, 0)
+        except OSError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=export) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert open(path, encoding="utf-8").read().endswith("# EOF\n")
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["metrics.txt"]
@@ -0,0 +1,137 @@
+import asyncio
+
+import pytest
+
+import jake_engine as engine
+import jake_engine_service as service_module
+
+
+def new_service():
+    return service_module.EngineService(max_concurrency=4, max_queued=4, max_sessions=100, session_ttl=3600)
+
+
+def run_turn(service, session, message, streamed=True):
+    return service_module.run_turn(service, session, message, dict(engine.DEFAULT_PERSONALITY), streamed)
+
+
+async def first_chunk(events):
+    async for kind, data in events:
+        if kind == "chunk":
+            return data
+
+
+def test_turn_closed_after_the_first_chunk_keeps_the_partial_reply():
+    async def scenario():
+        service = new_service()
+        session = service_module.ServiceSession()
+        events = run_turn(service, session, "hello there")
+        chunk = await first_chunk(events)
+        await events.aclose()
+        return session, chunk
+
+    session, chunk = asyncio.run(scenario())
+    assert list(session.chat_history) == [("user", "hello there", None), ("assistant", chunk, None)]
+    assert len(session.turn_metrics) == 1
+    assert session.response_cache.stats()["entries"] == 0
+    assert not session.lock.locked()
+
+
+def test_turn_cancelled_mid_stream_keeps_the_partial_reply(monkeypatch):
+    monkeypatch.setattr(engine, "MOCK_CHUNK_DELAY_SCALE", 1) # Waits between chunks, where the task is cancelled
+
+    async def scenario():
+        service = new_service()
+        session = service_module.ServiceSession()
+        received = []
+
+        async def consume():
+            async for kind, data in run_turn(service, session, "second"):
+                if kind == "chunk":
+                    received.append(data)
+
+        task = asyncio.create_task(consume())
+        while not received:
+            await asyncio.sleep(0.001)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return service, session, received
+
+    service, session, received = asyncio.run(scenario())
+    assert list(session.chat_history) == [("user", "second", None), ("assistant", "".join(received), None)]
+    assert len(session.turn_metrics) == 1
+    assert service.limiter.active == 0
+
+
+def test_turn_cancelled_before_the_first_chunk_is_dropped(monkeypatch):
+    monkeypatch.setattr(engine, "MOCK_LATENCY", ("fixed", (10.0,)))
+
+    async def scenario():
+        service = new_service()
+        session = service_module.ServiceSession()
+        task = asyncio.create_task(first_chunk(run_turn(service, session, "never mind")))
+        while not session.lock.locked():
+            await asyncio.sleep(0.001)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return session
+
+    session = asyncio.run(scenario())
+    assert list(session.chat_history) == []
+    assert len(session.turn_metrics) == 1
+
+
+@pytest.mark.parametrize("personality, valid", [
+    ({}, True),
+    ({"empathy": 3, "humor_style": "Dry", "adventurous_spirit": False, "relationship_type": "Romantic Partner",
+      "sexual_orientation_to_user": "Straight"}, True),
+    ({"sexual_orientation_to_user": None}, True),
+    ({"relationship_type": 5}, False),
+    ({"empathy": "high"}, False),
+    ({"empathy": True}, False),
+    ({"adventurous_spirit": 1}, False),
+    ({"sexual_orientation_to_user": 2}, False),
+    ({"favorite_color": "blue"}, False),
+    (["empathy", 3], False),
+])
+def test_valid_personality(personality, valid):
+    assert service_module.valid_personality(personality) is valid
+
+
+def test_failed_turn_leaves_the_history_as_it_was():
+    async def scenario():
+        service = new_service()
+        session = service_module.ServiceSession()
+        personality = {**engine.DEFAULT_PERSONALITY, "relationship_type": 5}
+        with pytest.raises(TypeError):
+            async for _ in service_module.run_turn(service, session, "hi", personality, streamed=False):
+                pass
+        return session
+
+    session = asyncio.run(scenario())
+    assert list(session.chat_history) == []
+    assert not session.lock.locked()
+
+
+def test_turn_failing_midway_keeps_the_partial_reply(monkeypatch):
+    def failing_chunks(text):
+        yield "Hello "
+        yield "there"
+        raise ConnectionError("stream dropped")
+
+    monkeypatch.setattr(engine, "reply_chunks", failing_chunks)
+
+    async def scenario():
+        service = new_service()
+        session = service_module.ServiceSession()
+        events = [event async for event in run_turn(service, session, "tell me a story")]
+        return session, events
+
+    session, events = asyncio.run(scenario())
+    shown = "".join(data for kind, data in events if kind == "chunk")
+    summary = events[-1][1]
+    assert shown == "Hello there"
+    assert summary["reply"] == shown
+    assert summary["error"] == "stream dropped"
+    assert session.chat_history[-1] == ("assistant", shown, None)
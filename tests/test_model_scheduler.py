@@ -0,0 +1,101 @@
+import threading
+import time
+
+import pytest
+
+import jake_engine as engine
+
+REQUESTS_PER_MINUTE = 600 # One grant every 0.1s once the bucket is empty
+
+
+def exhausted_scheduler(hold_seconds=0.2):
+    """A scheduler whose request bucket stays empty for `hold_seconds`, so requests queue up until then."""
+    scheduler = engine.ModelScheduler(requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=0)
+    scheduler.request_bucket.tokens = -hold_seconds * REQUESTS_PER_MINUTE / 60
+    return scheduler
+
+
+def queue_requests(scheduler, requests, timeout=10):
+    """
+    Starts one thread per (user id, priority) request, each queued only after the previous one, and
+    returns the threads and the list their user ids are appended to as their requests are granted.
+    """
+    granted = []
+    lock = threading.Lock()
+
+    def request(user_id, priority):
+        scheduler.acquire(user_id, 1, priority=priority, timeout=timeout)
+        with lock:
+            granted.append(user_id)
+
+    def submitted():
+        stats = scheduler.stats()
+        return stats["queued"] + stats["granted"]
+
+    already_submitted = submitted()
+    threads = []
+    for count, (user_id, priority) in enumerate(requests, 1):
+        thread = threading.Thread(target=request, args=(user_id, priority))
+        thread.start()
+        threads.append(thread)
+        while submitted() < already_submitted + count:
+            time.sleep(0.001)
+    return threads, granted
+
+
+def join(threads):
+    for thread in threads:
+        thread.join(timeout=10)
+    assert not any(thread.is_alive() for thread in threads)
+
+
+def test_users_take_turns():
+    scheduler = exhausted_scheduler()
+    interactive = engine.PRIORITY_INTERACTIVE
+    requests = [("alice", interactive)] * 4 + [("bob", interactive)] * 2 + [("carol", interactive)]
+    threads, granted = queue_requests(scheduler, requests)
+    join(threads)
+    assert granted == ["alice", "bob", "carol", "alice", "bob", "alice", "alice"]
+
+
+def test_interactive_requests_go_before_background_ones():
+    scheduler = exhausted_scheduler()
+    requests = [("alice", engine.PRIORITY_BACKGROUND)] * 2 + [("bob", engine.PRIORITY_INTERACTIVE)]
+    threads, granted = queue_requests(scheduler, requests)
+    join(threads)
+    assert granted == ["bob", "alice", "alice"]
+
+
+def test_unthrottled_requests_are_granted_at_once():
+    scheduler = engine.ModelScheduler(requests_per_minute=0, tokens_per_minute=0)
+    assert scheduler.acquire("alice", 10_000) < 0.1
+    assert scheduler.stats() == {"queued": 0, "granted": 1, "timeouts": 0}
+
+
+def test_timed_out_request_leaves_the_queue():
+    scheduler = exhausted_scheduler(hold_seconds=0)
+    with pytest.raises(engine.QuotaTimeout):
+        scheduler.acquire("alice", 1, timeout=0.02)
+    assert scheduler.stats() == {"queued": 0, "granted": 0, "timeouts": 1}
+    assert scheduler.queues == {}
+
+
+def test_requests_behind_a_timed_out_one_are_granted():
+    scheduler = exhausted_scheduler(hold_seconds=0)
+    errors = []
+
+    def impatient():
+        try:
+            scheduler.acquire("alice", 1, timeout=0.02)
+        except engine.QuotaTimeout as e:
+            errors.append(e)
+
+    impatient_thread = threading.Thread(target=impatient)
+    impatient_thread.start()
+    while not scheduler.stats()["queued"]:
+        time.sleep(0.001)
+    threads, granted = queue_requests(scheduler, [("bob", engine.PRIORITY_INTERACTIVE)])
+    join([impatient_thread, *threads])
+    assert len(errors) == 1
+    assert granted == ["bob"]
+    assert scheduler.stats() == {"queued": 0, "granted": 1, "timeouts": 1}